@@ -0,0 +1,6 @@
+"""
+# Benchmarks
+
+Performance harness of Pyccoon: [[corpus.py]] generates synthetic source trees and \
+[[run.py]] measures the throughput of the build stages on them and compares it to a baseline.
+"""
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+"""
+## Synthetic corpus
+
+Reproducible source trees for the benchmarks. The same `seed` always gives the same files, so \
+that the numbers of two runs are comparable.
+
+Every corpus mixes Python, C, JavaScript, Ruby, Haskell and Clojure files, and comes in a few \
+shapes that stress different parts of Pyccoon:
+
+  * `many` - lots of small files, dominated by the per-file overhead
+  * `large` - a few very long files
+  * `comments` - comment-dense files, dominated by Markdown
+  * `code` - code-dense files, dominated by Pygments
+"""
+
+import os
+import random
+from io import open
+
+WORDS = ("the of and to in is that it for with as on by this be are from at or an source "
+         "file page section parse render code comment value list result index folder tree "
+         "cache build language output return function module string number").split()
+
+# `{name}`, `{arg}` and `{num}` are filled in for every function.
+LANGUAGES = {
+    'python': {
+        'extension':    '.py',
+        'comment':      '# {0}',
+        'block':        ('    """', '    {0}', '    """'),
+        'code':         ['def {name}({arg}, limit={num}):',
+                         '    result = []',
+                         '    for item in range({arg}):',
+                         '        if item % {num} == 0:',
+                         '            result.append(item * {num})',
+                         '    return sum(result) + len("{name}")'],
+    },
+    'c': {
+        'extension':    '.c',
+        'comment':      '// {0}',
+        'block':        ('/*', ' * {0}', ' */'),
+        'code':         ['static int {name}(int {arg}) {{',
+                         '    int result = 0;',
+                         '    for (int i = 0; i < {arg}; i++) {{',
+                         '        result += i * {num};',
+                         '    }}',
+                         '    return result;',
+                         '}}'],
+    },
+    'javascript': {
+        'extension':    '.js',
+        'comment':      '// {0}',
+        'block':        ('/*', ' * {0}', ' */'),
+        'code':         ['function {name}({arg}) {{',
+                         '    var result = [];',
+                         '    for (var i = 0; i < {arg}.length; i++) {{',
+                         '        result.push({arg}[i] * {num});',
+                         '    }}',
+                         '    return result.join(", ");',
+                         '}}'],
+    },
+    'ruby': {
+        'extension':    '.rb',
+        'comment':      '# {0}',
+        'block':        ('=begin', '{0}', '=end'),
+        'code':         ['def {name}({arg})',
+                         '  result = {arg}.map do |item|',
+                         '    item * {num}',
+                         '  end',
+                         '  result.select {{ |item| item.even? }}.sum',
+                         'end'],
+    },
+    'haskell': {
+        'extension':    '.hs',
+        'comment':      '-- {0}',
+        'block':        ('{-', '  {0}', '-}'),
+        'code':         ['{name} :: [Int] -> Int',
+                         '{name} {arg} = sum (map (* {num}) (filter even {arg}))'],
+    },
+    'clojure': {
+        'extension':    '.clj',
+        'comment':      ';; {0}',
+        'block':        None,
+        'code':         ['(defn {name}',
+                         '  [{arg}]',
+                         '  (->> {arg}',
+                         '       (map #(* % {num}))',
+                         '       (filter even?)',
+                         '       (reduce +)))'],
+    },
+}
+
+# `shape: (files per language, functions per file, comment lines per function)`
+SHAPES = {
+    'many':     (40, 4, 3),
+    'large':    (1, 400, 4),
+    'comments': (8, 20, 16),
+    'code':     (8, 60, 1),
+}
+
+
+def sentence(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def comment(rng, language, lines):
+    """ A comment of `lines` lines with a bit of Markdown in it """
+    text = ["## " + sentence(rng, 3).capitalize()]
+    for _ in range(lines - 1):
+        line = sentence(rng, 10)
+        if rng.random() < 0.2:
+            line += " `" + rng.choice(WORDS) + "()`"
+        text.append(line)
+    if language['block'] and rng.random() < 0.3:
+        start, middle, end = language['block']
+        return [start] + [middle.format(line) for line in text] + [end]
+    return [language['comment'].format(line) for line in text]
+
+
+def function(rng, language, number):
+    fields = {'name': "{0}_{1}".format(rng.choice(WORDS), number),
+              'arg': rng.choice(WORDS) + "s",
+              'num': rng.randint(2, 99)}
+    return [line.format(**fields) for line in language['code']]
+
+
+def source(rng, language, functions, comment_lines):
+    lines = comment(rng, language, comment_lines + 2)
+    for number in range(functions):
+        lines.append("")
+        lines.extend(comment(rng, language, comment_lines))
+        lines.extend(function(rng, language, number))
+    return "\n".join(lines) + "\n"
+
+
+def generate(folder, shape, seed=0, scale=1.0):
+    """
+    ### Generating a corpus
+    Write the corpus of the given `shape` to `folder`, one subfolder per language. `scale` \
+    multiplies the number of files. Return the total size in bytes.
+    """
+    rng = random.Random(seed * len(SHAPES) + sorted(SHAPES).index(shape))
+    files, functions, comment_lines = SHAPES[shape]
+    total = 0
+    for name in sorted(LANGUAGES):
+        language = LANGUAGES[name]
+        subfolder = os.path.join(folder, name)
+        if not os.path.isdir(subfolder):
+            os.makedirs(subfolder)
+        for i in range(max(1, int(files * scale))):
+            data = source(rng, language, functions, comment_lines).encode('utf8')
+            with open(os.path.join(subfolder, "file{0}{1}".format(i, language['extension'])),
+                      'wb') as f:
+                f.write(data)
+            total += len(data)
+    return total
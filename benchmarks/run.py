@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+
+"""
+## Running the benchmarks
+
+    python -m benchmarks.run [--save] [--baseline FILE] [--threshold 0.25]
+
+Measures the throughput (source bytes per second) of `Language.parse`, of the Pygments pass of \
+`Pyccoon.highlight` and of `Language.markdown` for every language of the [[corpus.py]], of \
+`Language.parse_tokens` (`tokens/...`, which does the work of parsing and highlighting), and of \
+the whole `Pyccoon.process` for every corpus shape, also in the `streaming` mode. The \
+`writers/...` builds make every written file `write_latency` slower, as on a slow disk or a \
+network file system, to compare writing in the main thread (`writers/0/...`) with the background \
+writer threads (`writers/2/...`). Each benchmark is run `--repeat` times and the best time is \
+kept; with `--only`, the other benchmarks are not run at all. The peak memory (RSS) of every \
+build is measured in a freshly started interpreter and reported as `rss/...` in kilobytes, where \
+less is better. So is the time in milliseconds of importing Pyccoon and of running \
+`pyccoon --version` in a fresh process, reported as `import/...`.
+
+With `--save` the results become the new baseline. Otherwise they are compared with the \
+baseline, and the run fails if any benchmark got slower by more than `--threshold`. Baselines \
+depend on the machine, so they are not shared: make one before changing the code.
+"""
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import random
+import optparse
+import tempfile
+import subprocess
+from contextlib import contextmanager
+from io import open
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from pyccoon import Pyccoon
+from pyccoon.languages import get_language_by_extension
+from pyccoon.output import OutputWriter
+
+from . import corpus
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# Benchmarks measuring a cost rather than a throughput.
+lower_is_better = ('rss/', 'import/')
+
+default_baseline = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# Seconds added to every written file by the `writers/...` benchmarks
+write_latency = 0.005
+
+
+def best_time(function, repeat, setup=lambda: None):
+    """ The shortest of `repeat` runs of `function(setup())` """
+    best = None
+    for _ in range(repeat):
+        argument = setup()
+        started = timer()
+        function(argument)
+        elapsed = timer() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def peak_memory():
+    """ Peak resident set size in KB of this process, or `None` where it cannot be measured. \
+        On Linux `ru_maxrss` keeps the peak of the process that forked this one even across \
+        `exec`, so the high-water mark of the current address space is read from `/proc`. """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+
+def fresh_env():
+    """ Environment of a fresh interpreter that imports this checkout of Pyccoon """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [root] + [path for path in [os.environ.get('PYTHONPATH')] if path]))
+
+
+def peak_rss(function, *args):
+    """ Peak resident set size in KB of a freshly started interpreter running `function(*args)`, \
+        where `function` is defined in this module and the `args` are JSON, or `None` where it \
+        cannot be measured. A forked process would start as big as the harness. """
+    script = ("import sys, json; from benchmarks import run; "
+              "run.{0}(*json.loads(sys.argv[1])); print(run.peak_memory())"
+              .format(function.__name__))
+    output = subprocess.check_output([sys.executable, '-c', script, json.dumps(args)],
+                                     env=fresh_env())
+    return None if output.strip() == b'None' else int(output)
+
+
+def build(sourcedir, outdir, streaming=False, writers=Pyccoon.writers):
+    Pyccoon({'sourcedir': sourcedir, 'outdir': outdir, 'verbosity': 0, 'streaming': streaming,
+             'writers': writers})
+
+
+@contextmanager
+def slow_writes(latency):
+    """ Make every file written or copied by `OutputWriter` (also in the background writer \
+        threads) take `latency` seconds longer """
+    write, copy = OutputWriter.write, OutputWriter.copy
+
+    def slow_write(self, path, data):
+        time.sleep(latency)
+        write(self, path, data)
+
+    def slow_copy(self, source, path):
+        time.sleep(latency)
+        copy(self, source, path)
+
+    OutputWriter.write, OutputWriter.copy = slow_write, slow_copy
+    try:
+        yield
+    finally:
+        OutputWriter.write, OutputWriter.copy = write, copy
+
+
+def selected(name, only):
+    """ Check if the benchmark `name` matches the `only` regular expression """
+    return not only or re.search(only, name) is not None
+
+
+def import_benchmarks(repeat, only=None):
+    """ Startup of a fresh interpreter: importing Pyccoon, and the whole `pyccoon --version` """
+    env = fresh_env()
+    script = ("import time; timer = getattr(time, 'perf_counter', time.time); "
+              "started = timer(); import pyccoon.pyccoon; print(timer() - started)")
+
+    def run_import(_):
+        return float(subprocess.check_output([sys.executable, '-c', script], env=env))
+
+    def run_version(_):
+        with open(os.devnull, 'wb') as devnull:
+            subprocess.check_call([sys.executable, '-m', 'pyccoon.pyccoon', '--version'],
+                                  env=env, stdout=devnull)
+
+    if selected('import/pyccoon', only):
+        yield 'import/pyccoon', None, min(run_import(None) for _ in range(repeat)) * 1000
+    if selected('import/version', only):
+        yield 'import/version', None, best_time(run_version, repeat) * 1000
+
+
+def language_benchmarks(repeat, only=None):
+    """ Parsing, Pygments highlighting and Markdown of a medium-sized file of every language, \
+        and parsing with the token parser """
+    for name in sorted(corpus.LANGUAGES):
+        if not any(selected(kind + name, only)
+                   for kind in ['parse/', 'highlight/', 'tokens/', 'markdown/']):
+            continue
+        spec = corpus.LANGUAGES[name]
+        code = corpus.source(random.Random(0), spec, 60, 4)
+        size = len(code.encode('utf8'))
+        language = get_language_by_extension("file" + spec['extension'])
+
+        sections = language.parse(code)
+        language.preprocess(sections)
+        docs = [section['docs_text'] for section in sections]
+        # What `Pyccoon.highlight` hands over to Pygments in a single call
+        joined = language.divider_text.join(section['code_text'].rstrip() for section in sections)
+
+        if selected('parse/' + name, only):
+            yield 'parse/' + name, size, best_time(lambda _: language.parse(code), repeat)
+        if selected('highlight/' + name, only):
+            yield 'highlight/' + name, size, best_time(lambda _: language.highlight(joined),
+                                                       repeat)
+        if selected('tokens/' + name, only):
+            yield 'tokens/' + name, size, best_time(lambda _: language.parse_tokens(code), repeat)
+        if selected('markdown/' + name, only):
+            yield 'markdown/' + name, size, best_time(
+                lambda _: [language.markdown(text) for text in docs], repeat)
+
+
+def process_benchmarks(repeat, scale, only=None):
+    """ Whole builds of every corpus shape, with and without streaming """
+    for shape in sorted(corpus.SHAPES):
+        modes = [(mode, streaming) for mode, streaming in [('process', False), ('streaming', True)]
+                 if any(selected(prefix + "{0}/{1}".format(mode, shape), only)
+                        for prefix in ['', 'rss/'])]
+        if not modes:
+            continue
+
+        folder = tempfile.mkdtemp()
+        outdirs = []
+
+        def setup():
+            outdirs.append(tempfile.mkdtemp())
+            return outdirs[-1]
+
+        try:
+            size = corpus.generate(folder, shape, scale=scale)
+            for mode, streaming in modes:
+                name = "{0}/{1}".format(mode, shape)
+                if selected(name, only):
+                    yield name, size, best_time(lambda outdir: build(folder, outdir, streaming),
+                                                repeat, setup=setup)
+                if selected('rss/' + name, only):
+                    yield 'rss/' + name, None, peak_rss(build, folder, setup(), streaming)
+        finally:
+            shutil.rmtree(folder)
+            for outdir in outdirs:
+                shutil.rmtree(outdir)
+
+
+def writer_benchmarks(repeat, scale, only=None):
+    """ Whole builds of the `many` corpus shape with slow writes, without and with the background \
+        writer threads """
+    names = [(writers, "writers/{0}/many".format(writers)) for writers in [0, 2]]
+    names = [(writers, name) for writers, name in names if selected(name, only)]
+    if not names:
+        return
+
+    folder = tempfile.mkdtemp()
+    outdirs = []
+
+    def setup():
+        outdirs.append(tempfile.mkdtemp())
+        return outdirs[-1]
+
+    results = []
+    try:
+        size = corpus.generate(folder, 'many', scale=scale)
+        with slow_writes(write_latency):
+            for writers, name in names:
+                results.append((name, size, best_time(
+                    lambda outdir: build(folder, outdir, writers=writers), repeat, setup=setup)))
+    finally:
+        shutil.rmtree(folder)
+        for outdir in outdirs:
+            shutil.rmtree(outdir)
+    for result in results:
+        yield result
+
+
+def run(repeat=3, scale=1.0, only=None):
+    """ Run the benchmarks whose names match `only`, the others are not even set up. Return \
+        `{name: bytes per second}` and `{rss/name: kilobytes}`. """
+    results = {}
+    for benchmarks in [import_benchmarks(repeat, only), language_benchmarks(repeat, only),
+                       process_benchmarks(repeat, scale, only),
+                       writer_benchmarks(repeat, scale, only)]:
+        for name, size, value in benchmarks:
+            if value is None:
+                continue
+            if name.startswith('rss/'):
+                results[name] = value
+                print("{0:<28s}{1:10d} KB peak".format(name, value))
+            elif name.startswith('import/'):
+                results[name] = value
+                print("{0:<28s}{1:10.1f} ms".format(name, value))
+            else:
+                results[name] = size / max(value, 1e-9)
+                print("{0:<28s}{1:10.1f} KB/s".format(name, results[name] / 1024))
+    return results
+
+
+def compare(results, baseline):
+    """ Return `(name, change)` of the benchmarks found in the `baseline`, with the change as a \
+        fraction: negative when the throughput dropped or the memory use or startup time grew """
+    return [(name, baseline[name] / value - 1 if name.startswith(lower_is_better) else
+             value / baseline[name] - 1)
+            for name, value in sorted(results.items()) if name in baseline]
+
+
+def main():
+    parser = optparse.OptionParser(usage="python -m benchmarks.run [options]")
+    parser.add_option('--baseline', action='store', dest='baseline', default=default_baseline,
+                      help='Baseline file (default: %default)')
+    parser.add_option('--save', action='store_true',
+                      help='Store the results as the new baseline')
+    parser.add_option('--threshold', action='store', dest='threshold', default=0.25,
+                      type='float',
+                      help='Allowed slowdown against the baseline, as a fraction (default: '
+                           '%default)')
+    parser.add_option('--repeat', action='store', dest='repeat', default=3, type='int',
+                      help='Runs of every benchmark, the best one counts (default: %default)')
+    parser.add_option('--scale', action='store', dest='scale', default=1.0, type='float',
+                      help='Multiplier of the number of corpus files (default: %default)')
+    parser.add_option('--only', action='store', dest='only',
+                      help='Only run the benchmarks matching this regular expression')
+    opts, _ = parser.parse_args()
+
+    results = run(opts.repeat, opts.scale, opts.only)
+
+    if opts.save:
+        with open(opts.baseline, 'wb') as f:
+            f.write(json.dumps(results, sort_keys=True, indent=1).encode('utf8'))
+        print("Baseline saved to {0}".format(opts.baseline))
+        return 0
+
+    if not os.path.exists(opts.baseline):
+        print("No baseline at {0}, run with --save to make one".format(opts.baseline))
+        return 0
+
+    with open(opts.baseline, 'rb') as f:
+        baseline = json.loads(f.read().decode('utf8'))
+
+    print("\nChange against the baseline:")
+    changes = compare(results, baseline)
+    for name, change in changes:
+        print("{0:<28s}{1:+8.1%}".format(name, change))
+
+    regressions = [(name, change) for name, change in changes if change < -opts.threshold]
+    for name, change in regressions:
+        print("Regression: {0} {1:+.1%}".format(name, change))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -39,3 +39,4 @@ __email__ = 'andrew.magalich@gmail.com'
 __version__ = '0.1.7'
 
 from .pyccoon import Pyccoon
+from .render import Renderer, render, render_many
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+"""
+## Build daemon
+
+Every run of `pyccoon` pays for importing Pygments, Markdown, pystache and YAML and for setting \
+up the lexers and the Markdown extensions before the first page is rendered. Hooks and editors \
+that call it many times a minute had better talk to a daemon instead:
+
+    pyccoon serve --daemon -s src -d docs
+
+keeps a warm `Pyccoon` instance listening on a Unix socket. Each request and each response is \
+a single line of JSON:
+
+    {"command": "build"}                                  full build
+    {"command": "build", "paths": ["/abs/src/a.py"]}      rebuild the pages of these files
+    {"command": "render", "path": "a.py", "code": "..."}  return the page HTML, write nothing
+    {"command": "ping"}
+    {"command": "stop"}
+
+Responses have `"ok": true` and the `time` spent, or `"ok": false` and the `error`. Paths may be \
+absolute or relative to the source folder. The `pyccoon client` command sends a request from the \
+command line, but any tool that can write to a Unix socket will do, e.g. \
+`echo '{"command": "build"}' | nc -U <socket>`.
+"""
+
+import os
+import json
+import time
+import socket
+import tempfile
+import threading
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from . import __version__
+from .utils import digest
+
+
+def default_socket(sourcedir):
+    """ Socket of the daemon serving the `sourcedir`, so that the clients find it by the sources \
+        alone """
+    name = 'pyccoon-{0}.sock'.format(digest(os.path.abspath(sourcedir))[:12])
+    return os.path.join(tempfile.gettempdir(), name)
+
+
+def request(path, message):
+    """ Send the `message` to the daemon listening at `path` and return its response """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall((json.dumps(message) + '\n').encode('utf8'))
+        line = sock.makefile('rb').readline()
+    finally:
+        sock.close()
+    if not line:
+        raise IOError("No response from the daemon at {0}".format(path))
+    return json.loads(line.decode('utf8'))
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+
+    """ Answers the requests of a single connection, one line each """
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            try:
+                response = self.server.dispatch(json.loads(line.decode('utf8')))
+            except Exception as e:
+                response = {'ok': False, 'error': str(e)}
+            self.wfile.write((json.dumps(response) + '\n').encode('utf8'))
+            self.wfile.flush()
+
+
+class Daemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    """
+    Serves the requests for a `pyccoon` instance on the Unix socket at `path`. Connections are \
+    accepted concurrently, but the requests are handled one at a time by a single worker thread. \
+    The Markdown converters and the Pygments formatters are cached per thread, so they stay warm \
+    in that thread from one request to the next instead of being built for every connection.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, pyccoon, path):
+        self.pyccoon = pyccoon
+        self.path = path
+        self.requests = Queue()
+
+        # A socket file left by a daemon that did not stop cleanly is removed.
+        if os.path.exists(path):
+            try:
+                request(path, {'command': 'ping'})
+            except (IOError, OSError, ValueError):
+                os.unlink(path)
+            else:
+                raise IOError("A daemon is already listening at {0}".format(path))
+
+        socketserver.UnixStreamServer.__init__(self, path, DaemonHandler)
+
+        self.worker = threading.Thread(target=self.work)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def serve(self):
+        self.pyccoon.log("Listening at {0}".format(self.path))
+        try:
+            self.serve_forever()
+        finally:
+            self.requests.put(None)
+            self.server_close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+    def work(self):
+        """ Handle the queued requests one at a time until `None` is queued """
+        while True:
+            task = self.requests.get()
+            if task is None:
+                return
+            message, reply = task
+            try:
+                reply.put((self.execute(message), None))
+            except Exception as e:
+                reply.put((None, e))
+
+    def dispatch(self, message):
+        """ Hand the `message` over to the worker thread and wait for its response """
+        reply = Queue(1)
+        self.requests.put((message, reply))
+        response, error = reply.get()
+        if error is not None:
+            raise error
+        return response
+
+    def execute(self, message):
+        command = message.get('command')
+        started = time.time()
+        if command == 'build':
+            response = self.build(message.get('paths'))
+        elif command == 'render':
+            response = {'html': self.render(message['path'], message.get('code'))}
+        elif command == 'ping':
+            response = {'version': __version__, 'sourcedir': self.pyccoon.sourcedir}
+        elif command == 'stop':
+            # `shutdown` waits for the request to finish, so it cannot be called from here.
+            threading.Thread(target=self.shutdown).start()
+            response = {}
+        else:
+            raise ValueError("Unknown command: {0}".format(command))
+        response.update(ok=True, time=time.time() - started)
+        return response
+
+    def source(self, path):
+        """ Path of a source file relative to the source folder """
+        return os.path.relpath(os.path.abspath(os.path.join(self.pyccoon.sourcedir, path)),
+                               self.pyccoon.sourcedir)
+
+    def build(self, paths=None):
+        """ Build everything, or only the pages of the `paths` and of the pages linking to them """
+        pyccoon = self.pyccoon
+        pyccoon.stats = {'rebuilt': 0, 'skipped': 0}
+        if not paths:
+            pyccoon.collect_sources()
+            pyccoon.process()
+        else:
+            sources = [self.source(path) for path in paths]
+            # New, deleted or renamed files change the folders, the sources are collected anew.
+            known = all(source in pyccoon.sources and
+                        os.path.exists(os.path.join(pyccoon.sourcedir, source))
+                        for source in sources)
+            pyccoon.regenerate(sources, collect=not known)
+        return {'stats': pyccoon.stats}
+
+    def render(self, path, code=None):
+        """ Render the page of the `path`, with the given `code` or the contents of the file """
+        return self.pyccoon.render_page(self.source(path), code)
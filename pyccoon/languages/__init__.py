@@ -2,30 +2,36 @@
 
 import re
 import os
+import bisect
+import threading
 
-import pygments
-from pygments import lexers, formatters
-
-from markdown import markdown
-from .. import markdown_extensions
+# Pygments, Markdown and the Markdown extensions take longer to import than the rest of Pyccoon,
+# so they are imported when the first page needs them, not before.
 
 from ..utils import cached_property
 from .utils import Section, ParsingStrategy, iterate_sections,\
     split_section_by_regex, split_code_by_pos
 
 
-default_markdown_extensions = [
-    markdown_extensions.LinesConnector(),
-    markdown_extensions.SaneDefList(),
-    markdown_extensions.Todo(),
-    markdown_extensions.Pydoc(),
-    markdown_extensions.AutoLinkExtension(),
-    markdown_extensions.MathExtension(),
-    "markdown.extensions.def_list",
-    "markdown.extensions.fenced_code",
-    'markdown.extensions.codehilite',
-    'markdown.extensions.tables'
-  ]
+def default_markdown_extensions():
+    """ The Markdown extensions every language uses """
+    from .. import markdown_extensions
+    return [
+        markdown_extensions.LinesConnector(),
+        markdown_extensions.SaneDefList(),
+        markdown_extensions.Todo(),
+        markdown_extensions.Pydoc(),
+        markdown_extensions.AutoLinkExtension(),
+        markdown_extensions.MathExtension(),
+        "markdown.extensions.def_list",
+        "markdown.extensions.fenced_code",
+        'markdown.extensions.codehilite',
+        'markdown.extensions.tables'
+    ]
+
+# Markdown converters of every language and Pygments formatters, built once per thread.
+_converters = threading.local()
+_formatters = threading.local()
 
 
 class Language(object):
@@ -40,29 +46,55 @@ class Language(object):
     extensions = []
     scope_keywords = []
     filename_substitutes = {}
-    markdown_extensions = default_markdown_extensions
     postprocessors = []
     preprocessors = []
+    # `"regex"` parses with the `strategy` alone, `"tokens"` with `parse_tokens`. Can be changed
+    # per language in the `documentation: parsers:` config.
+    parser = "regex"
+    # Steps of the `strategy` that `parse_tokens` replaces with the comment and docstring tokens.
+    splitting_steps = ('parse_inline', 'parse_multiline')
+    # Runs of blank lines, which the `strategy` may shorten or add
+    blank_lines_re = re.compile(r'(\n\s*\n)')
   
     
     @property
     def name(self):
         return self.__class__.__name__
 
+    @cached_property
+    def markdown_extensions(self):
+        return default_markdown_extensions()
+
     @cached_property
     def lexer(self):
         """ Pygments lexer corresponding to the language """
+        from pygments import lexers
         return lexers.get_lexer_by_name(self.name.lower())
 
     def highlight(self, code, formatter="html"):
         """ Use pygments to highlight the `code` """
-        return pygments.highlight(
-            code, self.lexer,
-            formatters.get_formatter_by_name(formatter)
-        )
+        import pygments
+        return pygments.highlight(code, self.lexer, self.formatter(formatter))
+
+    def formatter(self, name):
+        """ The Pygments formatter `name` of the current thread """
+        cached = _formatters.__dict__
+        if name not in cached:
+            from pygments import formatters
+            cached[name] = formatters.get_formatter_by_name(name)
+        return cached[name]
 
     def markdown(self, docs):
-        return markdown(docs, extensions=self.markdown_extensions)
+        """ Render the `docs`. Building a converter with all the extensions is expensive, so it \
+            is done once and the converter is reset before each use. """
+        converters = _converters.__dict__
+        converter = converters.get(self.name)
+        if converter is None:
+            # The `Markdown` name is taken by the language below.
+            from markdown import Markdown as MarkdownConverter
+            converter = MarkdownConverter(extensions=self.markdown_extensions)
+            converters[self.name] = converter
+        return converter.reset().convert(docs)
 
     def transform_filename(self, filename):
         """
@@ -92,9 +124,11 @@ class Language(object):
 
     def parse(self, code, add_lineno=True):
         """ Apply `self.strategy()` to the `code` """
-        sections = [Section(code_text=code)]
+        return self.apply_strategy([Section(code_text=code)], self.strategy())
 
-        for method in self.strategy():
+    def apply_strategy(self, sections, strategy):
+        """ Apply the methods of the `strategy` to the `sections` """
+        for method in strategy:
             sections = method(sections)
 
         # Strip empty sections
@@ -102,6 +136,167 @@ class Language(object):
 
         return sections
 
+    def parse_tokens(self, code):
+        """
+        ### Token-driven parsing
+        The `regex` parser splits the code with regular expressions, and the code sections are \
+        highlighted afterwards by another pass of Pygments over the code joined with dividers. \
+        Here the lexer runs once instead: the comment and docstring tokens that `token_docs` \
+        accepts become the docs, and the `code_html` of every section is formatted from the \
+        same tokens. The rest of the `strategy` (scopes, merging) is applied as usual.
+        """
+        from pygments.token import Comment, String
+
+        # As in `Lexer.get_tokens`, which is bypassed here to keep the positions in the `code`.
+        if isinstance(code, bytes):
+            code = code.decode('utf8')
+        if not code.endswith('\n'):
+            code += '\n'
+
+        # Pygments may split a multiline comment into several tokens, e.g. `{-`, ` doc ` and `-}`
+        # in Haskell.
+        positions, tokens = [], []
+        for pos, ttype, value in self.lexer.get_tokens_unprocessed(code):
+            if tokens and ttype is tokens[-1][0] and ttype in Comment.Multiline:
+                tokens[-1] = (ttype, tokens[-1][1] + value)
+            else:
+                positions.append(pos)
+                tokens.append((ttype, value))
+
+        # Spans of the docs: `(start, end, docs_text, inline)`. A docs token is the first one on
+        # its line, and the span starts with the line.
+        spans = []
+        kinds = {}
+        for i, (ttype, value) in enumerate(tokens):
+            kind = kinds.get(ttype, False)
+            if kind is False:
+                if ttype in Comment.Preproc or ttype in Comment.Hashbang:
+                    kind = None
+                elif ttype in Comment.Multiline:
+                    kind = 'multiline'
+                elif ttype in Comment:
+                    kind = 'comment'
+                elif ttype in String.Doc:
+                    kind = 'docstring'
+                elif ttype in String:
+                    kind = 'string'
+                else:
+                    kind = None
+                kinds[ttype] = kind
+            if not kind:
+                continue
+
+            pos = positions[i]
+            line_start = code.rfind('\n', 0, pos) + 1
+            if code[line_start:pos].strip():
+                continue
+            end = pos + len(value)
+            docs = self.token_docs(kind, value, not code[end:code.find('\n', end)].strip())
+            if docs is None:
+                continue
+
+            text, inline = docs
+            if not inline:
+                spans.append((line_start, end, code[line_start:pos] + text, False))
+                continue
+            if code[end - 1] != '\n' and code[end] == '\n':
+                end += 1
+            if spans and spans[-1][3] and spans[-1][1] == line_start:
+                spans[-1] = (spans[-1][0], end, spans[-1][2] + text, True)
+            else:
+                spans.append((line_start, end, text, True))
+
+        sections, start = [], 0
+        for begin, end, text, _ in spans:
+            if code[start:begin].strip():
+                sections.append(Section(docs_text='', code_text=code[start:begin].strip('\n')))
+            sections.append(Section(docs_text=text, code_text=''))
+            start = end
+        if code[start:].strip():
+            sections.append(Section(docs_text='', code_text=code[start:].strip('\n')))
+
+        strategy = [method for method in self.strategy()
+                    if method.__name__ not in self.splitting_steps]
+        sections = self.apply_strategy(sections, strategy)
+        self.highlight_sections(sections, code, positions, tokens, spans)
+        return sections
+
+    def highlight_sections(self, sections, code, positions, tokens, spans):
+        """
+        Set the `code_html` of the `sections` (without the `<pre>` wrapper) from the `tokens` \
+        of the `code` starting at the `positions`. The code of every section is looked up in \
+        the `code` after the previous one, outside of the docs `spans`. A section that cannot \
+        be found, e.g. with the lines glued by `python_absorb`, is highlighted on its own.
+        """
+        from pygments import format as format_tokens
+        from pygments.token import Text
+
+        formatter = self.formatter("html")
+        wrapper_start = '<div class="highlight"><pre>'
+        wrapper_end = '</pre></div>\n'
+        span_starts = [span[0] for span in spans]
+
+        def find(text, cursor):
+            """ Position of the `text` in the code after the `cursor`, outside of the docs """
+            start = code.find(text, cursor)
+            while start >= 0:
+                k = bisect.bisect_right(span_starts, start)
+                if (k == 0 or spans[k - 1][1] <= start) and \
+                        (k == len(spans) or span_starts[k] >= start + len(text)):
+                    return start
+                start = code.find(text, start + 1)
+            return None
+
+        cursor = 0
+        for section in sections:
+            text = section['code_text'].rstrip().lstrip('\n')
+            if not text:
+                section['code_html'] = ''
+                continue
+
+            # Steps like `absorb` change the blank lines between the parts of a section, so the
+            # parts are looked up one by one.
+            pieces, position = [], cursor
+            for i, part in enumerate(self.blank_lines_re.split(text)):
+                if i % 2:
+                    pieces.append((Text, part))
+                    continue
+                start = find(part, position)
+                if start is None:
+                    pieces = None
+                    break
+                end = start + len(part)
+                a = bisect.bisect_right(positions, start) - 1
+                b = bisect.bisect_left(positions, end)
+                first = len(pieces)
+                pieces.extend(tokens[a:b])
+                ttype, value = pieces[-1]
+                pieces[-1] = (ttype, value[:end - positions[b - 1]])
+                ttype, value = pieces[first]
+                pieces[first] = (ttype, value[start - positions[a]:])
+                position = end
+
+            if pieces is None:
+                html = self.highlight(text)
+            else:
+                html = format_tokens(pieces, formatter)
+                cursor = position
+
+            if html.startswith(wrapper_start):
+                html = html[len(wrapper_start):]
+            if html.endswith(wrapper_end):
+                html = html[:-len(wrapper_end)]
+            section['code_html'] = html.rstrip('\n')
+
+    def token_docs(self, kind, value, line_end):
+        """
+        The docs of a token starting a line, as `(docs_text, inline)`, or `None` if it is code. \
+        `kind` is `"comment"`, `"multiline"` (comment), `"docstring"` or `"string"`, `line_end` \
+        tells if nothing but whitespace follows the token on its last line. The docs of \
+        consecutive `inline` comments are joined.
+        """
+        return None
+
     @iterate_sections(start=0)
     def debug_docs(self, sections, i):
         print(sections[i]['docs_text'])
@@ -179,6 +374,9 @@ class PlainText(Language):
     def parse(self, code, add_lineno=True):
         return [Section(docs_text=code)]
 
+    def parse_tokens(self, code):
+        return self.parse(code)
+
     def lexer(self):
         return None
 
@@ -260,6 +458,20 @@ class InlineCommentLanguage(Language):
         return re.compile(r'\n*<span class="c[1]?">{0}DIVIDER</span>\n*'
                           .format(self.inline_delimiter))
 
+    @cached_property
+    def ignored_inline_re(self):
+        return re.compile("|".join(self.ignored_inline_patterns)) \
+            if self.ignored_inline_patterns else None
+
+    def token_docs(self, kind, value, line_end):
+        delimiter = self.inline_delimiter
+        # A single line comment, unless it is one of the ignored ones
+        if kind == 'comment' and value.startswith(delimiter) and '\n' not in value.rstrip('\n'):
+            ignored = self.ignored_inline_re
+            if not (ignored and ignored.match(value, len(delimiter))):
+                return value[len(delimiter):].rstrip('\n') + '\n', True
+        return super(InlineCommentLanguage, self).token_docs(kind, value, line_end)
+
     @iterate_sections(start=0)
     def parse_inline(self, sections, i):
         new_sections = split_section_by_regex(sections[i], self.inline_re)
@@ -310,6 +522,20 @@ class MultilineCommentLanguage(Language):
     def multiline_delimiters(self):
         return [self.multistart, self.multiend]
 
+    @cached_property
+    def multiline_token_re(self):
+        """ A whole multiline comment token """
+        return re.compile(r'(?:{0})(?P<docs>[\s\S]*?)(?:{1})\Z'.format(self.multistart,
+                                                                      self.multiend))
+
+    def token_docs(self, kind, value, line_end):
+        if kind in ('comment', 'multiline', 'docstring'):
+            match = self.multiline_token_re.match(value)
+            if match and not (self.multiline_ignore_start and
+                              re.match(self.multiline_ignore_start, match.group('docs'))):
+                return match.group('docs'), False
+        return super(MultilineCommentLanguage, self).token_docs(kind, value, line_end)
+
     def strategy(self):
         base_strategy = super(MultilineCommentLanguage, self).strategy()
         base_strategy.insert(0, self.parse_multiline)
@@ -333,6 +559,12 @@ class DoubleQuoteDocstringLanguage(Language):
     def multiline_re(self):
         return re.compile(r'^(\s*"(?:[^"\\]|\\.)*)"(?=\n)', flags=re.M)
 
+    def token_docs(self, kind, value, line_end):
+        if kind in ('string', 'docstring') and line_end and len(value) > 1 and \
+                value.startswith('"') and value.endswith('"'):
+            return value[1:-1].replace('\\', ''), False
+        return super(DoubleQuoteDocstringLanguage, self).token_docs(kind, value, line_end)
+
     def strategy(self):
         base_strategy = super(DoubleQuoteDocstringLanguage, self).strategy()
         base_strategy.insert(0, self.parse_multiline)
@@ -647,8 +879,10 @@ class Haskell(InlineCommentLanguage, MultilineCommentLanguage):
     # The markup format, however, is easy, and that's what we
     # intend to support.
     # See the extension definition for details.
-    markdown_extensions = \
-        default_markdown_extensions + [markdown_extensions.Haddock()]
+    @cached_property
+    def markdown_extensions(self):
+        from .. import markdown_extensions
+        return default_markdown_extensions() + [markdown_extensions.Haddock()]
 
 
 # ## Languages in development
@@ -694,11 +928,14 @@ class Clojure(IndentBasedLanguage,
     extensions = [".cljs", ".clj"]
     inline_delimiter = ";;"
 
-    nsLinksExt = markdown_extensions.NsLinks()
-    nsLinksExt.namespace_re = "\S+/"
     anchor_prefix = '_'
 
-    markdown_extensions = default_markdown_extensions + [nsLinksExt]
+    @cached_property
+    def markdown_extensions(self):
+        from .. import markdown_extensions
+        nsLinksExt = markdown_extensions.NsLinks()
+        nsLinksExt.namespace_re = "\S+/"
+        return default_markdown_extensions() + [nsLinksExt]
 
     scope_keywords = [r"^\s*\((def\S*)((\s+\^:\S*)*)\s+([^\s\)]*)",
                       r"^\s*\((ns)\s+([^\s\)]*)"]
@@ -708,8 +945,8 @@ class Lua(InlineCommentLanguage, MultilineCommentLanguage):
     """### Lua"""
     extensions = [".lua"]
     inline_delimiter = "--"
-    multistart = "--[["
-    multiend = "--]]"
+    multistart = r"--\[\["
+    multiend = r"--\]\]"
 
 
 class Erlang(InlineCommentLanguage):
@@ -725,8 +962,13 @@ class Tcl(InlineCommentLanguage):
 
     
 # ## Gathering all languages
+#
+# The extensions and the names are mapped to the classes. A language is instantiated when the
+# first file needs it, and its instance is shared by all the files after that.
 
 extensions_mapping = {}
+names_mapping = {}
+_instances = {}
 
 
 languages = [Markdown, Python, Fortran, PHP, C,
@@ -734,32 +976,169 @@ languages = [Markdown, Python, Fortran, PHP, C,
     CoffeeScript, Perl, SQL, Scheme, Clojure]
 
 for language in languages:
-    instance = language()
-    for extension in instance.extensions:
-        extensions_mapping[extension] = instance
+    for extension in language.extensions:
+        extensions_mapping[extension] = language
+    # `name` is the class name, unless a language sets it as a class attribute.
+    names_mapping[language.__name__ if isinstance(language.name, property) else language.name] = \
+        language
+
+
+def language_instance(language):
+    """ The shared instance of the `language` class """
+    instance = _instances.get(language)
+    if instance is None:
+        instance = _instances.setdefault(language, language())
+    return instance
+
+
+def find_language(name):
+    """ The language whose name is `name`, e.g. `Python`, or `None` """
+    language = names_mapping.get(name)
+    return language_instance(language) if language else None
 
 
 def get_language(source, code, language=None):
-    """Get the current language we're documenting, based on the extension."""
+    """Get the current language we're documenting, based on the extension, the file name or \
+    the contents."""
 
     if language is not None:
-        for l in extensions_mapping.values():
-            if l.name == language:
-                return l
-        else:
+        instance = find_language(language)
+        if instance is None:
             raise ValueError("Unknown forced language: " + language)
+        return instance
 
+    return get_language_by_extension(source) or get_language_by_filename(source) or \
+        sniff_language(code) or guess_language(code)
+
+
+def get_language_by_extension(source):
+    """ Get the language by the extension of the `source` file name, if it is a known one """
     m = re.match(r'.*(\..+)', os.path.basename(source))
 
     if m and m.group(1) in extensions_mapping:
-        return extensions_mapping[m.group(1)]
-    else:
-        try:
-            lang = lexers.guess_lexer(code).name.lower()
-        except Exception:
-            return None
-        for l in extensions_mapping.values():
-            if l.name == lang:
-                return l
-        else:
-            return None
+        return language_instance(extensions_mapping[m.group(1)])
+
+
+# ## Sniffing the language
+#
+# Files without a known extension are recognized by their name, or by the first and the last
+# lines of the code, before Pygments is asked.
+
+filenames_mapping = {
+    'SConstruct':   Python,
+    'SConscript':   Python,
+    'wscript':      Python,
+    'Rakefile':     Ruby,
+    'Gemfile':      Ruby,
+    'Guardfile':    Ruby,
+    'Vagrantfile':  Ruby,
+    'Podfile':      Ruby,
+    'Capfile':      Ruby,
+    'Berksfile':    Ruby,
+    'Jakefile':     JavaScript,
+    'Cakefile':     CoffeeScript,
+}
+
+# Interpreters of the shebang lines and language names of the modelines, without the versions.
+language_aliases = {
+    'python':       Python,
+    'ruby':         Ruby,
+    'node':         JavaScript,
+    'nodejs':       JavaScript,
+    'javascript':   JavaScript,
+    'js':           JavaScript,
+    'php':          PHP,
+    'perl':         Perl,
+    'lua':          Lua,
+    'escript':      Erlang,
+    'erlang':       Erlang,
+    'tclsh':        Tcl,
+    'wish':         Tcl,
+    'tcl':          Tcl,
+    'runghc':       Haskell,
+    'runhaskell':   Haskell,
+    'haskell':      Haskell,
+    'coffee':       CoffeeScript,
+    'coffeescript': CoffeeScript,
+    'guile':        Scheme,
+    'scheme':       Scheme,
+    'clojure':      Clojure,
+    'c':            C,
+    'cpp':          C,
+    'c++':          C,
+    'fortran':      Fortran,
+    'sql':          SQL,
+    'markdown':     Markdown,
+}
+
+emacs_modeline = re.compile(r'-\*-(.*?)-\*-')
+vim_modeline = re.compile(r'\b(?:vi|vim|ex):.*?\b(?:ft|filetype|syntax)=([\w+-]+)')
+
+# Pygments only sees this many first characters of the code.
+guess_prefix_size = 16384
+
+
+def get_language_by_filename(source):
+    """ Get the language of well-known file names, e.g. `Rakefile` """
+    language = filenames_mapping.get(os.path.basename(source))
+    return language_instance(language) if language else None
+
+
+def get_language_by_alias(alias):
+    """ The language of an interpreter or a modeline name, e.g. `python3.6` or `c++` """
+    alias = alias.lower()
+    language = language_aliases.get(alias) or language_aliases.get(alias.rstrip('0123456789.'))
+    return language_instance(language) if language else None
+
+
+def sniff_language(code):
+    """
+    Recognize the language by the shebang line (`#!/usr/bin/env python3`), an Emacs modeline \
+    in the first two lines (`-*- mode: ruby -*-`) or a Vim modeline in the first or the last \
+    five lines (`vim: set ft=lua:`). Only the start and the end of the `code` are looked at.
+    """
+    head = code[:1024].split('\n')[:5]
+    tail = code[-1024:].split('\n')[-5:]
+
+    if head and head[0].startswith('#!'):
+        words = head[0][2:].split()
+        # `#!/usr/bin/env -S VAR=1 python3 -u`
+        if words and os.path.basename(words[0]) == 'env':
+            words = [word for word in words[1:] if not word.startswith('-') and '=' not in word]
+        if words:
+            language = get_language_by_alias(os.path.basename(words[0]))
+            if language:
+                return language
+
+    for line in head[:2]:
+        match = emacs_modeline.search(line)
+        if match:
+            fields = match.group(1).strip()
+            mode = re.search(r'(?:^|;)\s*mode:\s*([\w+-]+)', fields) if ':' in fields else None
+            name = mode.group(1) if mode else (fields if ':' not in fields else None)
+            language = get_language_by_alias(name) if name else None
+            if language:
+                return language
+
+    for line in head + tail:
+        match = vim_modeline.search(line)
+        if match:
+            language = get_language_by_alias(match.group(1))
+            if language:
+                return language
+
+
+def guess_language(code):
+    """ Ask Pygments to guess the language of the `code`. This is slow: every lexer is tried, \
+        so only the first `guess_prefix_size` characters are given to it. """
+    from pygments import lexers
+    try:
+        lexer = lexers.guess_lexer(code[:guess_prefix_size])
+    except Exception:
+        return None
+    # The lexer names (`Python 3`) are not the language names, but the aliases (`python3`) are
+    # known from the shebang lines.
+    for alias in [lexer.name] + list(lexer.aliases):
+        language = find_language(alias) or get_language_by_alias(alias)
+        if language:
+            return language
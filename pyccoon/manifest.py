@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""
+## Build manifest
+
+The manifest is a small JSON file kept in the output folder. For every processed source file it
+remembers the fingerprints of everything the generated page depends on: the source contents,
+the detected language, the project config, the page template and CSS, and the Pyccoon version.
+
+On the next build a page whose fingerprints did not change is skipped instead of being parsed,
+highlighted and rendered again. The manifest also keeps the cross-reference `DependencyGraph`, so
+that a page is rebuilt when a source it links to is renamed, moved or deleted.
+"""
+
+import os
+import json
+from io import open
+
+
+class BuildManifest(object):
+
+    filename = '.pyccoon-manifest.json'
+
+    def __init__(self, outdir):
+        self.path = os.path.join(outdir, self.filename)
+        self.entries = {}
+        self.dependencies = DependencyGraph()
+        self.load()
+
+    def load(self):
+        """ Read the manifest of the previous build. A missing or broken file means a full \
+            build. """
+        try:
+            with open(self.path, 'rb') as f:
+                data = json.loads(f.read().decode('utf8'))
+            self.entries = data.get('entries', {})
+            self.dependencies = DependencyGraph(data.get('dependencies'))
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+
+    def save(self):
+        data = json.dumps({'entries': self.entries, 'dependencies': self.dependencies.to_dict()},
+                          sort_keys=True, indent=1)
+        with open(self.path, 'wb') as f:
+            f.write(data.encode('utf8'))
+
+    def is_fresh(self, source, inputs, destination):
+        """ Check if the page of `source` was built from exactly the same `inputs` and still \
+            exists in the output folder """
+        return self.entries.get(source) == inputs and os.path.exists(destination)
+
+    def update(self, source, inputs):
+        self.entries[source] = inputs
+
+    def forget(self, source):
+        """ Make sure the page of `source` is rebuilt next time """
+        self.entries.pop(source, None)
+
+    def prune(self, sources):
+        """ Forget the files that are not among the `sources` anymore """
+        for source in list(self.entries):
+            if source not in sources:
+                del self.entries[source]
+        self.dependencies.prune(sources)
+
+
+class DependencyGraph(object):
+
+    """
+    ## Cross-reference dependencies
+
+    A `[[crossref]]` link is rendered from the destination of the source it points to. For \
+    every page the graph keeps the `(target, anchor, destination)` of each of its links, and \
+    the anchors the page defines itself.
+
+    When a target is renamed, moved or deleted its destination changes, and the pages linking \
+    to it are stale even though their own sources did not change.
+    """
+
+    def __init__(self, data=None):
+        data = data or {}
+        self.references = dict((page, [tuple(reference) for reference in references])
+                               for page, references in data.get('references', {}).items())
+        self.anchors = dict((page, set(anchors))
+                            for page, anchors in data.get('anchors', {}).items())
+
+    def record(self, page, references, anchors):
+        """ Remember the links and the anchors of the freshly built `page` """
+        self.references[page] = [tuple(reference) for reference in references]
+        self.anchors[page] = set(anchors)
+
+    def prune(self, pages):
+        """ Forget the pages that are not among the `pages` anymore """
+        for page in list(self.references):
+            if page not in pages:
+                del self.references[page]
+                self.anchors.pop(page, None)
+
+    def referrers(self, targets):
+        """ Pages linking to any of the `targets` """
+        targets = set(targets)
+        return set(page for page, references in self.references.items()
+                   if any(target in targets for target, _, _ in references))
+
+    def is_stale(self, page, destination):
+        """ Check if any link of the `page` would now point elsewhere. `destination(target)` \
+            gives the current destination of a target. """
+        return any(destination(target) != path
+                   for target, _, path in self.references.get(page, []))
+
+    def broken_links(self):
+        """ Yield `(page, target, anchor)` for links to anchors the known targets do not define """
+        for page, references in sorted(self.references.items()):
+            for target, anchor, _ in references:
+                if anchor and target in self.anchors and anchor not in self.anchors[target]:
+                    yield page, target, anchor
+
+    def to_dict(self):
+        return {
+            'references':   dict((page, [list(reference) for reference in references])
+                                 for page, references in self.references.items()),
+            'anchors':      dict((page, sorted(anchors)) for page, anchors in self.anchors.items()),
+        }
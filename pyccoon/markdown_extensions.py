@@ -1,8 +1,6 @@
 import re
 import os
 
-import pypandoc
-
 from markdown.util import etree, AtomicString
 from markdown.inlinepatterns import Pattern
 from markdown.preprocessors import Preprocessor
@@ -309,6 +307,7 @@ class Haddock(Extension):
             # The rest of the text (after the last characteristic) is normal Haddock text.
             rest = lines[i:]
             # Use *pypandoc* to convert Haddocks markup into HTML
+            import pypandoc
             converted_rest = pypandoc.convert('\n'.join(rest), 'html', format='haddock')
 
             if characteristics_block:
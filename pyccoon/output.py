@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+
+"""
+## Output writers
+
+All the files Pyccoon produces go through a writer. `OutputWriter` writes them right away, \
+while `BackgroundWriter` hands them over to a few I/O threads, so that the next page is \
+rendered while the previous one is still being written. This pays off on slow disks and network \
+file systems.
+
+With `compare` on, a file is only written when its bytes differ from the existing output, so \
+unchanged files keep their modification time and sync tools or caches do not see them as new.
+
+When the destination is an archive, e.g. `-d docs.zip` or `-d docs.tar.gz`, `ArchiveWriter` \
+streams every file into it instead, under the same paths the output folder would have.
+
+With `precompress`, a `Precompressor` writes `.gz` (and `.br`, if the `brotli` package is \
+installed) siblings of the HTML, CSS, JavaScript and SVG files for static servers that send them \
+as they are. The variants are compressed in a thread pool while the next pages are rendered.
+"""
+
+import os
+import time
+import shutil
+import importlib
+import threading
+from io import open, BytesIO
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from .utils import digest, ensure_directory
+from .profiler import NoProfiler
+
+# Archive extensions and the `tarfile` compressions, `zip` is handled by `zipfile`.
+archive_formats = [
+    ('.zip', 'zip'),
+    ('.tar', ''),
+    ('.tar.gz', 'gz'),
+    ('.tgz', 'gz'),
+    ('.tar.bz2', 'bz2'),
+    ('.tar.xz', 'xz'),
+]
+
+
+# Modules the `tarfile` compressions need. Python 2 has no `lzma` and its `tarfile` no `xz`.
+archive_modules = {'gz': 'zlib', 'bz2': 'bz2', 'xz': 'lzma'}
+
+
+def archive_format(path):
+    """ Return `(extension, compression)` of the archive at `path`, or `None` for a folder """
+    for extension, compression in archive_formats:
+        if path.lower().endswith(extension):
+            return extension, compression
+
+
+def archive_available(compression):
+    """ Check if archives with the `compression` can be written by this Python """
+    import tarfile
+    if compression in archive_modules:
+        try:
+            importlib.import_module(archive_modules[compression])
+        except ImportError:
+            return False
+    return compression in ('zip', '') or compression in tarfile.TarFile.OPEN_METH
+
+
+def file_digest(path):
+    with open(path, 'rb') as f:
+        return digest(f.read())
+
+
+def is_same_file(path, data=None, source=None):
+    """ Check if the existing file at `path` has the given `data` or the contents of the `source` \
+        file. Sizes are compared first, so most changed files are never read. """
+    try:
+        size = len(data) if source is None else os.path.getsize(source)
+        if os.path.getsize(path) != size:
+            return False
+        return file_digest(path) == (digest(data) if source is None else file_digest(source))
+    except (IOError, OSError):
+        return False
+
+
+def gzip_compress(data):
+    """ Gzip the `data` without a time stamp or a file name, so the result depends on it alone """
+    import gzip
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0, filename='') as f:
+        f.write(data)
+    return buf.getvalue()
+
+
+def brotli_compress(data):
+    import brotli
+    return brotli.compress(data)
+
+
+compressors = {'gz': gzip_compress, 'br': brotli_compress}
+
+
+def compression_available(compression):
+    """ Check if the module of the `compression` is installed """
+    if compression == 'br':
+        try:
+            importlib.import_module('brotli')
+        except ImportError:
+            return False
+    return compression in compressors
+
+
+class Precompressor(object):
+
+    """
+    Writes the compressed `formats` (`gz`, `br`) of the text files in a pool of `threads`, or \
+    right away if `threads` is 0. At most twice as many files as there are threads wait to be \
+    compressed. A variant is only written again if its file changed.
+    """
+
+    extensions = ('.html', '.css', '.js', '.svg')
+
+    def __init__(self, formats, threads=None):
+        unknown = [f for f in formats if f not in compressors]
+        if unknown:
+            raise ValueError("Unknown or unavailable compression: {0}".format(", ".join(unknown)))
+        self.formats = list(formats)
+        self.failures = []
+        from multiprocessing import cpu_count
+        from multiprocessing.pool import ThreadPool
+        self.threads = cpu_count() if threads is None else threads
+        self.pool = ThreadPool(self.threads) if self.threads else None
+        self.slots = threading.BoundedSemaphore(2 * self.threads or 1)
+
+    def submit(self, path, data=None, changed=True):
+        """ Compress the file at `path`, whose contents are `data` if they are at hand """
+        if not path.endswith(self.extensions):
+            return
+        formats = [f for f in self.formats if changed or not os.path.exists(path + '.' + f)]
+        if not formats:
+            return
+        if self.pool is None:
+            self.done(self.compress(path, data, formats))
+            return
+        self.slots.acquire()
+        self.pool.apply_async(self.compress, (path, data, formats), callback=self.done)
+
+    def compress(self, path, data, formats):
+        try:
+            if data is None:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            for compression in formats:
+                with open(path + '.' + compression, 'wb') as f:
+                    f.write(compressors[compression](data))
+        except Exception as e:
+            return path, e
+
+    def done(self, failure):
+        if failure:
+            self.failures.append(failure)
+        if self.pool is not None:
+            self.slots.release()
+
+    def flush(self):
+        """ Wait for the queued files and return the `(path, error)` failures """
+        for _ in range(2 * self.threads):
+            self.slots.acquire()
+        for _ in range(2 * self.threads):
+            self.slots.release()
+        failures, self.failures = self.failures, []
+        return failures
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+
+class OutputWriter(object):
+
+    """
+    Writes the files synchronously. `files` counts the written files and `changed` the ones \
+    whose contents actually changed. The written files are handed over to the `precompress` \
+    `Precompressor`, if there is one.
+    """
+
+    def __init__(self, compare=False, precompress=None):
+        self.compare = compare
+        self.precompress = precompress
+        self.files = self.changed = 0
+
+    def write(self, path, data):
+        """ Write `data` (bytes or text) to the file at `path` """
+        if not isinstance(data, bytes):
+            data = data.encode('utf8')
+        if self.compare and is_same_file(path, data=data):
+            self.count(1, 0)
+            if self.precompress:
+                self.precompress.submit(path, data, changed=False)
+            return
+        with open(path, 'wb') as f:
+            f.write(data)
+        self.count(1, 1)
+        if self.precompress:
+            self.precompress.submit(path, data)
+
+    def copy(self, source, path):
+        """ Copy the `source` file to `path` """
+        if self.compare and is_same_file(path, source=source):
+            self.count(1, 0)
+            if self.precompress:
+                self.precompress.submit(path, changed=False)
+            return
+        shutil.copyfile(source, path)
+        self.count(1, 1)
+        if self.precompress:
+            self.precompress.submit(path)
+
+    def makedirs(self, path):
+        """ Create the folder `path` for the files written to it """
+        ensure_directory(path)
+
+    def count(self, files, changed):
+        """ Add to the counters, e.g. the files written by another process """
+        self.files += files
+        self.changed += changed
+
+    def flush(self):
+        """ Wait until everything is written. Return the list of `(path, error)` failures. """
+        return self.precompress.flush() if self.precompress else []
+
+    def close(self):
+        if self.precompress:
+            self.precompress.close()
+
+    def abort(self):
+        """ Stop after a failed build, the files written so far stay """
+        self.close()
+
+
+class BackgroundWriter(OutputWriter):
+
+    """
+    Writes the files in `threads` background threads. At most `maxsize` files wait in the \
+    queue; after that, the producer blocks until the writers catch up, so the memory stays bounded.
+    Every file is timed as a `write` stage of the `profiler`, in the thread writing it.
+    """
+
+    def __init__(self, threads=2, maxsize=32, compare=False, precompress=None, profiler=None):
+        OutputWriter.__init__(self, compare, precompress)
+        self.profiler = profiler or NoProfiler()
+        self.queue = Queue(maxsize)
+        self.failures = []
+        self.lock = threading.Lock()
+        self.threads = []
+        for _ in range(threads):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def write(self, path, data):
+        self.queue.put(('write', path, data))
+
+    def copy(self, source, path):
+        self.queue.put(('copy', path, source))
+
+    def work(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                kind, path, argument = task
+                with self.profiler.stage('write', path):
+                    if kind == 'copy':
+                        OutputWriter.copy(self, argument, path)
+                    else:
+                        OutputWriter.write(self, path, argument)
+            except Exception as e:
+                with self.lock:
+                    self.failures.append((path, e))
+            finally:
+                self.queue.task_done()
+
+    def count(self, files, changed):
+        with self.lock:
+            OutputWriter.count(self, files, changed)
+
+    def flush(self):
+        self.queue.join()
+        with self.lock:
+            failures, self.failures = self.failures, []
+        return failures + OutputWriter.flush(self)
+
+    def close(self):
+        """ Stop the threads after the queued files are written """
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        OutputWriter.close(self)
+
+
+class MemoryWriter(OutputWriter):
+
+    """
+    Keeps the files in memory instead, for the worker processes that send their pages to the \
+    parent to be written there.
+    """
+
+    def __init__(self):
+        OutputWriter.__init__(self)
+        self.pending = []
+
+    def write(self, path, data):
+        self.pending.append((path, data))
+
+    def copy(self, source, path):
+        with open(source, 'rb') as f:
+            self.pending.append((path, f.read()))
+
+    def makedirs(self, path):
+        pass
+
+    def take(self):
+        """ Return the `(path, data)` pairs kept so far and forget them """
+        pending, self.pending = self.pending, []
+        return pending
+
+
+class ArchiveWriter(OutputWriter):
+
+    """
+    Streams the files into the zip or tar archive at `path`, named by their paths relative to \
+    `root`. The archive is written next to `path` and moved there on `close`, so a failed build \
+    does not leave a truncated archive behind. Every entry gets the `mtime` timestamp, the \
+    current time by default.
+    """
+
+    def __init__(self, path, root, mtime=None):
+        OutputWriter.__init__(self)
+        self.path = path
+        self.root = root
+        self.mtime = int(time.time() if mtime is None else mtime)
+
+        import tarfile
+        _, compression = archive_format(path)
+        if not archive_available(compression):
+            raise tarfile.CompressionError("{0} archives are not supported by this Python"
+                                           .format(os.path.basename(path)))
+        ensure_directory(os.path.dirname(path))
+        self.temporary = path + '.tmp'
+        self.file = open(self.temporary, 'wb')
+        self.zip = self.tar = self.gzip = None
+        try:
+            self.open(compression)
+        except BaseException:
+            self.abort()
+            raise
+
+    def open(self, compression):
+        """ Start the archive of the `compression` in the temporary file """
+        import gzip
+        import tarfile
+        import zipfile
+        if compression == 'zip':
+            self.zip = zipfile.ZipFile(self.file, 'w', zipfile.ZIP_DEFLATED)
+        else:
+            # `tarfile` stamps the gzip header with the current time, which is set here instead.
+            if compression == 'gz':
+                self.gzip = gzip.GzipFile(fileobj=self.file, mode='wb', mtime=self.mtime,
+                                          filename='')
+                self.tar = tarfile.open(fileobj=self.gzip, mode='w', format=tarfile.GNU_FORMAT)
+            else:
+                self.tar = tarfile.open(fileobj=self.file, mode='w:' + compression,
+                                        format=tarfile.GNU_FORMAT)
+
+    def name(self, path):
+        return os.path.relpath(path, self.root).replace(os.sep, '/')
+
+    def write(self, path, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf8')
+        name = self.name(path)
+        import tarfile
+        import zipfile
+        if self.zip is not None:
+            # Zip timestamps start in 1980.
+            info = zipfile.ZipInfo(name, max(time.gmtime(self.mtime)[:6], (1980, 1, 1, 0, 0, 0)))
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0o644 << 16
+            self.zip.writestr(info, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size, info.mtime, info.mode = len(data), self.mtime, 0o644
+            self.tar.addfile(info, BytesIO(data))
+        self.count(1, 1)
+
+    def copy(self, source, path):
+        with open(source, 'rb') as f:
+            self.write(path, f.read())
+
+    def makedirs(self, path):
+        pass
+
+    def close(self):
+        """ Finish the archive and move it in place """
+        for archive in [self.zip, self.tar, self.gzip, self.file]:
+            if archive is not None:
+                archive.close()
+        os.rename(self.temporary, self.path)
+
+    def abort(self):
+        """ Close and remove the unfinished archive, an archive of a previous build stays """
+        for archive in [self.zip, self.tar, self.gzip, self.file]:
+            if archive is not None:
+                try:
+                    archive.close()
+                except Exception:
+                    pass
+        if os.path.exists(self.temporary):
+            os.remove(self.temporary)
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+
+"""
+## Build profiler
+
+With `--profile`, every page is timed stage by stage: reading the source, parsing it into \
+sections, preprocessing the comments, highlighting the code with Pygments, rendering the \
+comments with Markdown, rendering the page template and writing the page. With the background \
+writer threads (`--writers`, on by default), the page is only put in their queue (`queue`, \
+which grows when the writers fall behind), and the writers time the `write` of each file \
+themselves.
+
+For each stage both the wall and the CPU time of its thread are recorded, along with the \
+number of sections and bytes of each file. The result is a JSON report with the stage breakdown \
+and the slowest files, and a \
+[Chrome trace](https://github.com/catapult-project/catapult/wiki/Trace-Event-Format) that can \
+be opened in `chrome://tracing` or Perfetto.
+
+Worker processes profile their own pages and send the events back with the results.
+"""
+
+import os
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+from io import open
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# CPU time of the current thread, so that the writer threads are not charged to the page that is
+# rendered meanwhile. `time.thread_time` appeared in Python 3.7 and `RUSAGE_THREAD` is Linux only
+# (the `resource` module of Python 2 does not name it). Elsewhere, the CPU time of the process.
+if hasattr(time, 'thread_time'):
+    cpu_time = time.thread_time
+elif resource is not None and sys.platform.startswith('linux'):
+    def cpu_time():
+        usage = resource.getrusage(getattr(resource, 'RUSAGE_THREAD', 1))
+        return usage.ru_utime + usage.ru_stime
+else:
+    cpu_time = getattr(time, 'process_time', None) or time.clock
+
+
+class NoProfiler(object):
+
+    """ Does nothing, used when the profiling is off """
+
+    @contextmanager
+    def stage(self, name, source):
+        yield
+
+    def count(self, source, code, sections):
+        pass
+
+    def take(self):
+        return None
+
+    def merge(self, profile):
+        pass
+
+
+class Profiler(NoProfiler):
+
+    """
+    Records `(source, stage, start, wall, cpu, pid, tid)` events and the sizes of the files.
+    """
+
+    # The stage covering the whole page, the others are nested in it.
+    page_stage = 'page'
+
+    def __init__(self):
+        self.events = []
+        self.sizes = {}
+        self.started = time.time()
+
+    @contextmanager
+    def stage(self, name, source):
+        """ Time the code inside the `with` block as the stage `name` of the `source` file """
+        start, cpu = time.time(), cpu_time()
+        try:
+            yield
+        finally:
+            self.events.append((source, name, start, time.time() - start, cpu_time() - cpu,
+                                os.getpid(), threading.current_thread().ident))
+
+    def count(self, source, code, sections):
+        self.sizes[source] = {'bytes': len(code.encode('utf8')), 'sections': len(sections)}
+
+    def take(self):
+        """ Return everything recorded so far and forget it (in worker processes) """
+        events, sizes = self.events, self.sizes
+        self.events, self.sizes = [], {}
+        return events, sizes
+
+    def merge(self, profile):
+        """ Add the events `take`n in a worker process """
+        if profile:
+            events, sizes = profile
+            self.events.extend(tuple(event) for event in events)
+            self.sizes.update(sizes)
+
+    def report(self, top=10):
+        """
+        ### Profile report
+        Totals per stage and the `top` slowest files with their own stage breakdown.
+        """
+        stages, files = {}, {}
+        for source, name, _, wall, cpu, _, _ in self.events:
+            if name == self.page_stage:
+                entry = files.setdefault(source, {'file': source, 'stages': {}})
+                entry['wall'], entry['cpu'] = wall, cpu
+                entry.update(self.sizes.get(source, {}))
+                continue
+            stage = stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})
+            stage['wall'] += wall
+            stage['cpu'] += cpu
+            stage['calls'] += 1
+            page = files.setdefault(source, {'file': source, 'stages': {}})['stages']
+            page[name] = page.get(name, 0.0) + wall
+
+        return {
+            'total': {
+                'wall':     time.time() - self.started,
+                'pages':    len([entry for entry in files.values() if 'wall' in entry]),
+                'bytes':    sum(size['bytes'] for size in self.sizes.values()),
+                'sections': sum(size['sections'] for size in self.sizes.values()),
+            },
+            'stages':   stages,
+            'slowest':  sorted((entry for entry in files.values() if 'wall' in entry),
+                               key=lambda entry: -entry['wall'])[:top],
+        }
+
+    def trace(self):
+        """ The events in the Chrome trace event format, in microseconds since the start """
+        events = sorted(self.events, key=lambda event: event[2])
+        return {
+            'displayTimeUnit': 'ms',
+            'traceEvents': [{
+                'name':     name,
+                'cat':      'pyccoon',
+                'ph':       'X',
+                'ts':       int((start - self.started) * 1e6),
+                'dur':      int(wall * 1e6),
+                'pid':      pid,
+                'tid':      tid,
+                'args':     {'file': source, 'cpu': cpu},
+            } for source, name, start, wall, cpu, pid, tid in events],
+        }
+
+    def save(self, path, top=10):
+        """ Write the report to `path` and the trace next to it, as `<name>.trace.json` """
+        trace_path = os.path.splitext(path)[0] + '.trace.json'
+        for filename, data in [(path, self.report(top)), (trace_path, self.trace())]:
+            with open(filename, 'wb') as f:
+                f.write(json.dumps(data, sort_keys=True, indent=1).encode('utf8'))
+        return trace_path
@@ -9,13 +9,15 @@
 
 
 import optparse
+import calendar
+import functools
+import itertools
 import os
 import shutil
-import pystache
 import re
 import sys
 import json
-import yaml
+import time
 from io import open
 from datetime import datetime
 from collections import defaultdict
@@ -23,27 +25,46 @@ from collections import defaultdict
 
 # This module contains all of our static resources.
 from . import resources, __version__, __author__
-from .languages import get_language, Language
+from .languages import get_language, get_language_by_extension, find_language, Language
+from .languages.utils import Section
 
-from .utils import shift, ensure_directory, SourceFile
+from .utils import shift, ensure_directory, digest, is_binary_string, combine_patterns, walk, \
+    split_chunks, \
+    SourceFile
+from .manifest import BuildManifest, DependencyGraph
+from .sources import SourceLoader, SourceTree
+from .output import OutputWriter, BackgroundWriter, MemoryWriter, ArchiveWriter, \
+    Precompressor, archive_format, archive_available, compression_available
+from .profiler import Profiler, NoProfiler
 
 
 # ## Main documentation generation class
 
-default_config = yaml.safe_load(r"""
-project:
-    name: NAME HERE
-verbosity: none
-files:
-    skip: []
-    copy: []
-documentation:
-    mathjax: false
-    linebreaking-behavior: normal
-    css-path: null
-    custom-html-template: null
-    
-""")
+# The keys are those of `.pyccoon.yaml`. YAML is only imported when there is a config file.
+default_config = {
+    'project': {
+        'name':                     'NAME HERE',
+    },
+    'verbosity':                    'none',
+    'files': {
+        'skip':                     [],
+        'copy':                     [],
+        'languages':                {},
+        'large': {
+            'size':                 None,
+            'lines':                None,
+            'mode':                 'chunk',
+            'chunk-lines':          2000,
+        },
+    },
+    'documentation': {
+        'mathjax':                  False,
+        'linebreaking-behavior':    'normal',
+        'css-path':                 None,
+        'custom-html-template':     None,
+        'parsers':                  {},
+    },
+}
 
 class Pyccoon(object):
 
@@ -60,6 +81,19 @@ class Pyccoon(object):
 
     config_file = '.pyccoon.yaml'
     watch = False
+    incremental = False
+    jobs = 1
+    writers = 2
+    compare = False
+    precompress = None
+    streaming = False
+    reproducible = False
+    generation_time = None
+    profile = None
+    profile_top = 10
+    profiler = NoProfiler()
+    shard = None
+    archive = None
     verbosity = -1
 
     outdir = sourcedir = None
@@ -73,14 +107,50 @@ class Pyccoon(object):
         Available parameters:
 
           * `sourcedir` - project source directory
-          * `outdir` - output directory
+          * `outdir` - output directory, or a `.zip`, `.tar`, `.tar.gz`, `.tgz`, `.tar.bz2` or \
+            `.tar.xz` archive that all the files are streamed into (`.tar.xz` needs Python 3)
           * `config_file` - pyccoon project settings
           * `watch` - whether to regenerate the docs automatically
+          * `incremental` - whether to skip the files that did not change since the last build
+          * `jobs` - number of worker processes generating the pages
+          * `writers` - number of threads writing the files in the background (0 to write them \
+            right away)
+          * `compare` - whether to write only the files whose contents changed, so that the \
+            unchanged ones keep their modification time
+          * `precompress` - list of the compressed variants (`gz`, `br`) to write next to the \
+            HTML, CSS, JavaScript and SVG files; implies `compare`
+          * `streaming` - whether to keep nothing of a file in memory once its page is written, \
+            so that the memory use does not grow with the size of the project
+          * `reproducible` - whether to generate the same output from the same sources, taking \
+            the generation time from `SOURCE_DATE_EPOCH` or the newest source file
+          * `profile` - path of the JSON profile report to write, see [[profiler.py]]
+          * `profile_top` - number of the slowest files listed in the profile report
+          * `shard` - `"K/N"` to render only the K-th of N parts of the pages, see \
+            [Sharded builds](#sharded-builds)
         """
 
         for key, value in opts.items():
             setattr(self, key, value)
 
+        if self.shard and not isinstance(self.shard, tuple):
+            match = re.match(r'^(\d+)/(\d+)$', self.shard)
+            if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+                raise ValueError("Invalid shard {0}, expected K/N with 1 <= K <= N"
+                                 .format(self.shard))
+            self.shard = (int(match.group(1)), int(match.group(2)))
+
+        # Variants are only compressed again when their file changed, which `compare` tells.
+        if self.precompress:
+            if not isinstance(self.precompress, (list, tuple)):
+                self.precompress = [f.strip() for f in self.precompress.split(',') if f.strip()]
+            unknown = [f for f in self.precompress if f not in ('gz', 'br')]
+            if unknown:
+                raise ValueError("Unknown compression: {0}".format(", ".join(unknown)))
+            if 'br' in self.precompress and not compression_available('br'):
+                self.log("The brotli package is not installed, no .br files are written")
+                self.precompress = [f for f in self.precompress if f != 'br']
+            self.compare = True
+
         self.log("Pyccoon {0}".format(__version__))
         self.log("-------------")
 
@@ -98,16 +168,30 @@ class Pyccoon(object):
         self.outdir = os.path.abspath(self.outdir)
         self.log("Output folder: " + self.outdir)
 
+        # The files in an archive are named as they would be in the output folder. Its previous
+        # contents are not read, so every build is a full one.
+        if archive_format(self.outdir):
+            self.archive = self.outdir
+            self.outdir = self.outdir[:-len(archive_format(self.outdir)[0])]
+            self.incremental = self.compare = False
+            if not archive_available(archive_format(self.archive)[1]):
+                raise ValueError("{0} archives are not supported by this Python"
+                                 .format(archive_format(self.archive)[0]))
+
         # Create the template that we will use to generate the Pyccoon HTML page.
         # If the user has supplied a path, we read it from there.
         if self.custom_html_template_path:
             with open(self.custom_html_template_path) as f:
-                html_template = f.read()
-            self.page_template = self.template(html_template)
+                self.page_template_source = f.read()
         # If not, we use the default.
         else:
-            self.page_template = self.template(resources.html)
+            self.page_template_source = resources.html
+        self.page_template = self.template(self.page_template_source)
 
+        self.loader = SourceLoader(self.sourcedir, self.page_destination,
+                                   self.language_patterns)
+        self.dependencies = DependencyGraph()
+        self.references, self.anchors = [], []
         self.collect_sources()
 
         if process:
@@ -125,8 +209,8 @@ class Pyccoon(object):
 
             from .utils import monitor
             monitor(path=self.sourcedir,
-                    file_modified=self.process,
-                    file_changed=self.collect_n_process)
+                    file_modified=self.regenerate,
+                    file_changed=functools.partial(self.regenerate, collect=True))
 
     def log(self, message):
         if self.verbosity:
@@ -134,15 +218,53 @@ class Pyccoon(object):
 
     def init_config(self):
         """ Try to get `.pyccoon.yaml` config file or use the default values """
+        # Every instance gets its own copy, and the sections of the config file are merged into
+        # the default ones, so that e.g. a `files:` section with `languages:` only keeps `skip:`.
+        self.config = dict((key, dict(value) if isinstance(value, dict) else value)
+                           for key, value in default_config.items())
         config_file = os.path.abspath(self.config_file)
         if os.path.exists(config_file):
             self.log('Using config {0:s}'.format(config_file))
+            import yaml
             with open(config_file, 'rb') as f:
-                self.config.update(yaml.safe_load(f.read().decode('utf8')))
+                for key, value in (yaml.safe_load(f.read().decode('utf8')) or {}).items():
+                    if isinstance(value, dict) and isinstance(self.config.get(key), dict):
+                        self.config[key].update(value)
+                    else:
+                        self.config[key] = value
 
         self.config['files']['skip'] = [re.compile(p) for p in self.config['files']['skip']]
         self.config['files']['copy'] = [re.compile(p) for p in self.config['files']['copy']]
 
+        # Every file name is matched against all the patterns at once.
+        self.skip_re = combine_patterns(self.config['files']['skip'])
+        self.copy_re = combine_patterns(self.config['files']['copy'])
+
+        # Thresholds of the [large files](#large-files), they may be given partially.
+        self.large_files = dict(default_config['files']['large'])
+        self.large_files.update(self.config['files'].get('large') or {})
+        if self.large_files['mode'] not in ('chunk', 'plain', 'copy'):
+            self.log("Unknown large files mode: {0}, using `chunk`"
+                     .format(self.large_files['mode']))
+            self.large_files['mode'] = 'chunk'
+
+        # Languages of the files matching glob patterns, e.g. `"scripts/*": Python`, which win
+        # over the extensions and the contents. Longer, more specific patterns are tried first.
+        self.language_patterns = []
+        for pattern, name in (self.config['files'].get('languages') or {}).items():
+            if find_language(name) is None:
+                self.log("Unknown language {0} of {1}, ignoring".format(name, pattern))
+            else:
+                self.language_patterns.append((pattern, name))
+        self.language_patterns.sort(key=lambda item: (-len(item[0]), item[0]))
+
+        # Parse engines of the languages, e.g. `Python: tokens`, see `Language.parse_tokens`.
+        parsers = self.config['documentation'].get('parsers') or {}
+        for name, parser in list(parsers.items()):
+            if parser not in ('regex', 'tokens'):
+                self.log("Unknown parser {0} of {1}, ignoring".format(parser, name))
+                del parsers[name]
+
         self.project_name = self.config['project']['name'] \
             or (os.path.split(self.sourcedir)[1] + " documentation")
 
@@ -169,42 +291,57 @@ class Pyccoon(object):
         else:
             self.custom_html_template_path = None
 
-    _textchars = bytearray([7, 8, 9, 10, 12, 13, 27]) + bytearray(range(0x20, 0x100))
+    is_binary_string = staticmethod(is_binary_string)
 
-    @classmethod
-    def is_binary_string(cls, bytes):
-        return bool(bytes.translate(None, cls._textchars))
+    def collect_sources(self, peek=False):
+        """
+        ## Collecting the sources
+        Collect names of all files to be copied or processed. Skipped folders are not descended \
+        into at all.
 
-    def collect_sources(self):
-        """ Collect names of all files to be copied or processed """
+        :param peek: Only read the first bytes of the files, enough to tell the binary ones. \
+            The rest is read when a page is rendered.
+        """
+        started = time.time()
         self.sources = {}
-        for dirpath, dirnames, files in os.walk(self.sourcedir):
-            if any([reg.search(dirpath) for reg in self.config['files']['skip']]):
-                continue
-            
+        self.tree = SourceTree(self.outdir)
+        self.loader.clear()
+
+        custom_css_path = self.custom_css_path and os.path.abspath(self.custom_css_path)
+
+        if self.skip_re.search(self.sourcedir):
+            folders = []
+        else:
+            folders = walk(self.sourcedir, skip=self.skip_re.search)
+
+        for dirpath, files in folders:
             for name in files:
-                if name in dirnames or any([reg.search(name) for reg in self.config['files']['skip']]):
+                if self.skip_re.search(name):
                     continue
 
-                
+                # The build manifest lives in the output folder, which may be inside the sources.
+                if name == BuildManifest.filename:
+                    continue
+
+                fullpath = os.path.join(dirpath, name)
+
                 # Don't copy the custom CSS file, if there is one.
                 # That file will be copied with the name specified by `resources.css_filename`.
-                if self.custom_css_path and \
-                   os.path.join(dirpath, name) == os.path.abspath(self.custom_css_path):
+                if fullpath == custom_css_path:
                     continue
 
-                fullpath = os.path.join(dirpath, name)
                 source = os.path.relpath(fullpath, self.sourcedir)
-                process = True
-                if any([regex.search(name) for regex in self.config['files']['copy']]):
-                    process = False
+                process = not self.copy_re.search(name)
 
                 prefix = None
                 if process:
-                    with open(fullpath, 'rb') as f:
-                        prefix = f.read(1024)
-                        if self.is_binary_string(prefix):
-                            process = False
+                    record = self.loader.load(source, peek=peek)
+                    prefix = record.prefix
+                    if record.binary or record.error:
+                        process = False
+                    elif self.large_files['mode'] == 'copy' and \
+                            self.is_large(self.loader.load(source).data):
+                        process = False
 
                 self.sources[source] = SourceFile(
                     source=source,
@@ -212,158 +349,643 @@ class Pyccoon(object):
                     process=process,
                     prefix=prefix
                 )
+                self.tree.add(self.sources[source].destination)
+                if self.streaming:
+                    self.loader.forget(source)
+
+        self.discovery_time = time.time() - started
+        self.log("Discovered {0} files in {1:.2f}s".format(len(self.sources), self.discovery_time))
 
     def collect_n_process(self):
         self.collect_sources()
         self.process()
 
-    def process(self, sources=None, language=None):
+    def regenerate(self, paths, collect=False):
+        """
+        ### Regenerating the changed files
+        Used by the `watch` mode to rebuild only the pages of the `paths` (relative to the \
+        `sourcedir`) that changed since the last build.
+
+        :param collect: Files or folders were created, deleted or moved. The sources are \
+            collected anew, and the index pages of the folders containing the `paths` are \
+            regenerated, because their contents have changed.
+        """
+        if collect:
+            self.collect_sources()
+
+        # The archive is written anew with everything in it. The sources are collected anew, as
+        # the generated index pages of the last build are not files to copy.
+        if self.archive:
+            if not collect:
+                self.collect_sources()
+            self.process()
+            return
+
+        sources = set(path for path in paths if path in self.sources)
+
+        # Pages linking to the changed files, if the links now point elsewhere
+        sources.update(page for page in self.dependencies.referrers(paths)
+                       if page in self.sources and
+                       self.dependencies.is_stale(page, self.destination))
+
+        folders = set()
+        if collect:
+            folders = set(os.path.dirname(path) for path in paths)
+            # Folders with their own index file (e.g. `__init__.py`) list the contents there.
+            indexes = set(os.path.join(self.outdir, folder, 'index.html') for folder in folders)
+            sources.update(source for source, sf in self.sources.items()
+                           if sf.destination in indexes)
+
+        # Nothing to do, e.g. the changed files are skipped or the outputs inside the `sourcedir`
+        if not sources and not folders:
+            return
+
+        self.process(sources=sources, indexes=folders)
+
+    def process_since(self, rev):
+        """
+        ### Building the changes since a revision
+        Regenerate only the pages of the files git reports as changed since the commit `rev`, \
+        see [[vcs.py]]. The outputs of the deleted files are removed, and the index pages of \
+        the folders that gained or lost files are generated again.
+
+        The pages linking to the changed files and the outputs of the deleted ones are known \
+        from the manifest of the previous build, so this needs `incremental` builds.
+        """
+        # Archives are always built in full.
+        if self.archive:
+            self.process()
+            return
+        if not self.incremental:
+            raise ValueError("Building the changes since a revision needs incremental builds")
+
+        from . import vcs
+        changed, deleted, moved = vcs.changes(self.sourcedir, rev)
+
+        manifest = BuildManifest(self.outdir)
+        if not os.path.exists(manifest.path):
+            self.log("No build manifest in {0}, building everything".format(self.outdir))
+            self.process()
+            return
+
+        self.log("{0} changed and {1} deleted files since {2}"
+                 .format(len(changed), len(deleted), rev))
+
+        for source in sorted(deleted):
+            self.remove_outputs(source, manifest)
+
+        self.dependencies = manifest.dependencies
+        self.regenerate(sorted(changed | deleted), collect=moved)
+
+    def remove_outputs(self, source, manifest):
+        """ Remove the outputs of the deleted `source`: its page or copy, the pages of a \
+            [large file](#large-files) and the compressed variants. The page is where the \
+            previous build in the `manifest` put it. """
+        entry = manifest.entries.get(source, {})
+        if 'destination' in entry:
+            destination = os.path.join(self.outdir, entry['destination'])
+        else:
+            destination = self.page_destination(source, get_language_by_extension(source))
+        paths = [destination, os.path.join(self.outdir, source)]
+        base, extension = os.path.splitext(destination)
+        i = 2
+        while os.path.exists("{0}.{1}{2}".format(base, i, extension)):
+            paths.append("{0}.{1}{2}".format(base, i, extension))
+            i += 1
+
+        # Outputs may share the folder with the sources, which are left alone.
+        keep = set(sf.destination for sf in self.sources.values())
+        keep.update(os.path.join(self.sourcedir, source) for source in self.sources)
+        for path in paths:
+            for variant in [path] + [path + '.' + f for f in self.precompress or []]:
+                if variant not in keep and os.path.isfile(variant):
+                    os.remove(variant)
+                    self.log("\tRemoved:\t{0:s}".format(os.path.relpath(variant, self.outdir)))
+
+    def process(self, sources=None, language=None, indexes=None):
         """
         ## Source files processing
 
         :param sources: `list` of source files to process  
-        :param language: Force programming language
-        """
+        :param language: Force programming language  
+        :param indexes: Folders whose generated index pages should be written. By default, all \
+            the folders without an index file get one.
 
+        If the build fails, the output is aborted: the writer threads are stopped and an \
+        unfinished archive is removed.
+        """
+        self.output = None
+        try:
+            self.build_outputs(sources, language, indexes)
+        except BaseException:
+            if self.output is not None:
+                self.output.abort()
+            raise
+
+    def build_outputs(self, sources, language, indexes):
+        """ Generate the pages and copy the files of the `process`ed sources """
         self.log('\n' + '-'*80)
         self.log("[{0}] Generating documentation for {1}".format(datetime.now(), self.project_name))
         self.log('-'*80 + '\n')
 
-        if sources:
+        if sources is not None:
             sources = dict([(k, v) for (k, v) in self.sources.items() if k in sources])
         else:
             sources = self.sources
 
-        ensure_directory(self.outdir)
-
-        # Handle CSS file which is either:
-        #
-        # - built from a default template
-        # - user specified (in which case it is not a template, but a normal file
-        #     to be used verbatim.
-
-        # If the user has supplied a path, we use that file.
-        if self.custom_css_path:
-            with open(self.custom_css_path) as f:
-                css_contents = f.read()
-        # Else, we use the default template.
+        # A shard renders only its part of the pages and leaves everything else to `merge`.
+        if self.shard:
+            sources = dict((k, v) for (k, v) in sources.items() if v.process and self.in_shard(k))
+            indexes = set()
+
+        self.profiler = Profiler() if self.profile else NoProfiler()
+        self.generation_time = self.source_date() if self.reproducible else None
+
+        # Files are written in the background while the next pages are rendered.
+        precompress = Precompressor(self.precompress) \
+            if self.precompress and not self.archive else None
+        if self.archive:
+            self.output = ArchiveWriter(self.archive, self.outdir, mtime=calendar.timegm(
+                (self.generation_time or datetime.utcnow()).timetuple()))
+        elif self.writers:
+            # When streaming, only a couple of pages may wait for the writers.
+            self.output = BackgroundWriter(self.writers, compare=self.compare,
+                                           maxsize=2 * self.writers if self.streaming else 32,
+                                           precompress=precompress, profiler=self.profiler)
         else:
-            # Currently, the only configurable item in the template is the linebreaking behavior
-            # of the text in documentation sections.
-            css_contents = pystache.render(resources.css,
-                                           {'linebreaking-behavior':
-                                            self.linebreaking_behavior})
+            self.output = OutputWriter(self.compare, precompress)
+        self.output.makedirs(self.outdir)
+
+        css_contents = self.stylesheet()
 
         # Now that we have specified the *contents* of the file, the code is equal in both
         # situations (*template* or *custom file*).
         filepath = os.path.join(os.path.split(resources.__file__)[0], resources.css_filename)
         destpath = os.path.join(self.outdir, resources.css_filename)
 
-        with open(destpath, 'w') as f:
-            f.write(css_contents)
+        if not self.shard:
+            self.output.write(destpath, css_contents)
 
-        # Handle static files
-        for filename, dest in resources.static_files:
-            filepath = os.path.join(os.path.split(resources.__file__)[0], filename)
+        # Handle static files. They are copied along with the other sources that are not processed.
+        for filename, dest in resources.static_files if not self.shard else []:
+            filepath = os.path.join(os.path.dirname(os.path.abspath(resources.__file__)), filename)
             destpath = os.path.join(self.outdir, dest)
-            self.sources[filepath] = SourceFile(source=filepath,
-                                                destination=destpath,
-                                                process=False,
-                                                prefix=None)
-
-            shutil.copyfile(
-                filepath,
-                destpath
-            )
+            self.sources[filepath] = sources[filepath] = SourceFile(source=filepath,
+                                                                    destination=destpath,
+                                                                    process=False,
+                                                                    prefix=None)
+            self.tree.add(destpath)
+
+        # With `incremental` builds, the manifest of the previous build tells which pages are
+        # still up to date.
+        manifest = BuildManifest(self.outdir) if self.incremental else None
+        if manifest:
+            self.dependencies = manifest.dependencies
+        self.stats = {'rebuilt': 0, 'skipped': 0}
 
         # Proceed to generating the documentation.
-        for sf in sorted(sources.values(), key=lambda x: x.destination):
+        pages = self.collect_pages(sources, manifest, css_contents, language)
+
+        written = {}
+        for sf, inputs, result in self.generate_pages(pages):
+            self.profiler.merge(result.get('profile'))
+            if result['error']:
+                self.log("Error while processing file {0:s}: {1}"
+                         .format(sf.source, result['error']))
+                continue
+
+            written[sf.destination] = sf.source
+            self.output.count(*result.get('output', (0, 0)))
+            for path, data in result.get('files', []):
+                self.output.write(path, data)
+            self.stats['rebuilt'] += 1
+            self.dependencies.record(sf.source, result['references'], result['anchors'])
+            if manifest:
+                manifest.update(sf.source, inputs)
+
+            self.log("\tProcessed:\t{0:s} -> {1:s}"
+                     .format(sf.source, os.path.relpath(sf.destination, self.outdir)))
+
+        # Ensure there is always an index file in every output folder
+        for folder in self.tree.missing_indexes():
+            source = os.path.join(folder, 'index.html')
+            destination = os.path.join(self.outdir, source)
+            self.sources[source] = \
+                SourceFile(source=source,
+                destination=destination,
+                process=False,
+                prefix=None)
+            self.tree.add(destination)
+
+            if indexes is not None and folder not in indexes:
+                continue
+
+            with self.profiler.stage('page', source):
+                self.language = Language()
+                with self.profiler.stage('render', source):
+                    html = self.generate_html(source, [])
+                self.write_page(source, destination, html)
+            self.log("\tGenerated:\t{0:s}".format(source))
+
+        # Wait for the writers. Pages that failed to be written have to be rebuilt next time.
+        failures = self.output.flush()
+        self.output.close()
+        for path, error in failures:
+            self.log("Error while writing file {0:s}: {1}".format(path, error))
+            if manifest and path in written:
+                manifest.forget(written[path])
+
+        if self.profile:
+            self.save_profile()
+
+        if self.compare:
+            self.log("Changed {0} of {1} output files."
+                     .format(self.output.changed, self.output.files))
+
+        if sources is self.sources:
+            self.dependencies.prune(self.sources)
+
+        for page, target, anchor in self.dependencies.broken_links():
+            self.log("Broken link in {0:s}: {1:s}#{2:s}".format(page, target, anchor))
+
+        if manifest:
+            if sources is self.sources:
+                manifest.prune(self.sources)
+            manifest.save()
+            self.log("Rebuilt {rebuilt} files, skipped {skipped} unchanged files."
+                     .format(**self.stats))
+
+        # The next build reads the sources anew.
+        self.loader.clear()
+        self.log("...Done.")
+
+    def stylesheet(self):
+        """
+        Contents of the CSS file which is either:
+
+        - built from a default template
+        - user specified (in which case it is not a template, but a normal file
+            to be used verbatim.
+        """
+
+        # If the user has supplied a path, we use that file.
+        if self.custom_css_path:
+            with open(self.custom_css_path) as f:
+                return f.read()
+
+        # Else, we use the default template.
+        # Currently, the only configurable item in the template is the linebreaking behavior
+        # of the text in documentation sections.
+        import pystache
+        return pystache.render(resources.css,
+                               {'linebreaking-behavior': self.linebreaking_behavior})
+
+    def render_page(self, source, code=None):
+        """
+        Render the page of the `source` file in memory, from the given `code` or the file \
+        contents, and return the HTML. Nothing is written.
+        """
+        try:
+            if code is None:
+                code = self.loader.load(source).text
+                language = self.loader.resolve(source).language
+            else:
+                language = self.loader.match(source) or get_language(source, code)
+            if not language:
+                raise ValueError("Unknown language of {0}".format(source))
+            self.language = language
+            return self.generate_documentation(source, code, language=language)
+        finally:
+            self.loader.clear()
+
+    def in_shard(self, source):
+        """
+        ### Sharded builds
+        A build can be split across several machines: each one runs with `--shard K/N` and \
+        renders only the pages whose source path hashes to its shard. Then `pyccoon merge` \
+        combines the output folders and adds what is shared: the stylesheet, the static and \
+        copied files and the folder index pages. The result is the same as a single build.
+        """
+        index, count = self.shard
+        return int(digest(source), 16) % count == index - 1
 
-            filepath = os.path.join(self.sourcedir, sf.source)
+    def merge(self, shards):
+        """ Combine the output folders of the `shards` in `outdir` and add the shared files """
+        if self.archive:
+            raise ValueError("Shards are merged into a folder, not an archive")
+        ensure_directory(self.outdir)
+        for shard in shards:
+            shard = os.path.abspath(shard)
+            for dirpath, files in walk(shard, skip=lambda path: False):
+                for name in files:
+                    if name == BuildManifest.filename:
+                        continue
+                    path = os.path.join(dirpath, name)
+                    destination = os.path.join(self.outdir, os.path.relpath(path, shard))
+                    ensure_directory(os.path.dirname(destination))
+                    shutil.copyfile(path, destination)
+            self.log("Merged:\t{0:s}".format(shard))
+
+        self.shard = None
+        self.process(sources=[source for source, sf in self.sources.items() if not sf.process])
+
+    def save_profile(self):
+        """ Write the profile report and trace, and log the time spent in each stage """
+        trace_path = self.profiler.save(self.profile, self.profile_top)
+        self.log("Profile written to {0:s} and {1:s}".format(self.profile, trace_path))
+        stages = self.profiler.report(self.profile_top)['stages']
+        for name, stage in sorted(stages.items(), key=lambda item: -item[1]['wall']):
+            self.log("\t{0:<12s}{1:8.3f}s wall{2:8.3f}s cpu"
+                     .format(name, stage['wall'], stage['cpu']))
+
+    def source_date(self):
+        """
+        ### Reproducible builds
+        The time stamped on the pages of a reproducible build: `SOURCE_DATE_EPOCH` if it is set, \
+        otherwise the modification time of the newest source file. It does not depend on the \
+        clock or on the time zone, so identical sources give byte-identical pages.
+        """
+        epoch = os.environ.get('SOURCE_DATE_EPOCH')
+        if epoch is not None:
+            try:
+                return datetime.utcfromtimestamp(int(epoch))
+            except ValueError:
+                self.log("Invalid SOURCE_DATE_EPOCH: {0:s}".format(epoch))
+
+        # The static resources are not part of the project.
+        stats = [self.loader.stat(source) for source in self.sources if not os.path.isabs(source)]
+        return datetime.utcfromtimestamp(max([int(stat[0]) for stat in stats if stat] or [0]))
+
+    def collect_pages(self, sources, manifest, css_contents, language=None):
+        """
+        ### Collecting the pages
+        Walk through the `sources` in order: copy the files that are not processed, skip the \
+        pages that are up to date and yield `(source file, code, language name, inputs)` for \
+        each page that has to be generated.
+        """
+        for sf in sorted(sources.values(), key=lambda x: x.destination):
             try:
                 if sf.process:
-                    with open(filepath, "rb") as f:
-                        code = f.read().decode('utf8')
+                    with self.profiler.stage('read', sf.source):
+                        code = self.loader.load(sf.source).text
 
-                    self.language = get_language(sf.source, code, language=language)
+                    if language:
+                        self.language = get_language(sf.source, code, language=language)
+                    else:
+                        self.language = self.loader.resolve(sf.source).language
                     self.parent = self
                     if not self.language:
                         self.sources[sf.source] = sf._replace(process=False)
                         sf = self.sources[sf.source]
 
                     try:
-                        ensure_directory(os.path.split(sf.destination)[0])
+                        self.output.makedirs(os.path.split(sf.destination)[0])
                     except OSError:
                         pass
 
                 if sf.process:
                     if os.path.exists(os.path.join(self.sourcedir, sf.source)):
-                        with open(sf.destination, "wb") as f:
-                            f.write(self.generate_documentation(sf.source, code,
-                                                                language=self.language)
-                                    .encode('utf8'))
-
-                        self.log("\tProcessed:\t{0:s} -> {1:s}"
-                                 .format(sf.source, os.path.relpath(sf.destination, self.outdir)))
+                        inputs = None
+                        if manifest:
+                            inputs = self.build_inputs(sf, code, css_contents)
+                            if manifest.is_fresh(sf.source, inputs, sf.destination) and \
+                               not self.dependencies.is_stale(sf.source, self.destination):
+                                self.stats['skipped'] += 1
+                                self.log("\tUp to date:\t{0:s}".format(sf.source))
+                                continue
+
+                        yield sf, code, self.language.name, inputs
+                        if self.streaming:
+                            self.loader.forget(sf.source)
                     else:
                         self.log("File does not exist: {0:s}".format(sf.source))
 
                 else:
-                    ensure_directory(os.path.split(sf.destination)[0])
-                    shutil.copyfile(os.path.join(self.sourcedir, sf.source), sf.destination)
+                    self.output.makedirs(os.path.split(sf.destination)[0])
+                    # Text files read while collecting the sources are not read again.
+                    record = self.loader.records.get(sf.source)
+                    if record is not None and record.data is not None:
+                        self.output.write(sf.destination, record.data)
+                    else:
+                        self.output.copy(os.path.join(self.sourcedir, sf.source), sf.destination)
                     self.log("\tCopied:   \t{0:s}".format(sf.source))
             except Exception as e:
                 self.log("Error while processing file {0:s}: {1}".format(sf.source, e))
 
-        # Ensure there is always an index file in the output folder
-        folders = set()
-        for sf in self.sources.values():
-            folder = os.path.relpath(os.path.split(sf.destination)[0], self.outdir).lstrip('./')
-            index = os.path.join(folder, "index.html")
-            while True:
-                if not any([os.path.join(self.outdir, index) == sf.destination
-                            for sf in self.sources.values()]):
-                    folders.add(folder)
-
-                if not folder:
-                    break
-                else:
-                    folder = os.path.split(folder)[0]
-
-        for folder in folders:
-            source = os.path.join(folder, 'index.html')
-            destination = os.path.join(self.outdir, source)
-            self.sources[source] = \
-                SourceFile(source=source,
-                destination=destination,
-                process=False,
-                prefix=None)
+    def generate_pages(self, pages):
+        """
+        ### Generating the pages
+        Generate the documentation of `pages` one by one, or fan them out to a pool of `jobs` \
+        worker processes. Either way, yield `(source file, inputs, result)` in the original order.
+        """
+        if self.jobs <= 1:
+            for sf, code, language, inputs in pages:
+                yield sf, inputs, self.generate_page(sf, code, language)
+            return
+
+        # When streaming, only a few pages per worker are read ahead. Otherwise all of them are
+        # handed over at once.
+        if self.streaming:
+            batches = iter(lambda: list(itertools.islice(pages, self.jobs * 4)), [])
+        else:
+            batches = [list(pages)]
 
-            with open(destination, 'w', encoding='utf8') as f:
-                    self.language = Language()
-                    f.write(self.generate_html(source, []))
-                    self.log("\tGenerated:\t{0:s}".format(source))
-        
-        self.log("...Done.")
+        # The workers get a copy of this instance once, when they start, and only the
+        # per-file arguments are sent over afterwards.
+        pool = None
+        try:
+            for batch in batches:
+                if not batch:
+                    continue
+                if pool is None:
+                    import multiprocessing
+                    pool = multiprocessing.Pool(self.jobs, initializer=_init_worker,
+                                                initargs=(self,))
+                results = pool.imap(_generate_page, [page[:3] for page in batch],
+                                    chunksize=max(1, len(batch) // (self.jobs * 4)))
+                for (sf, _, _, inputs), result in zip(batch, results):
+                    yield sf, inputs, result
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def generate_page(self, sf, code, language):
+        """
+        Parse, highlight and render the page of a single source file and write it out. \
+        Return the `references` and `anchors` of the page, and the `error` message if it fails.
+        """
+        result = {'references': [], 'anchors': [], 'error': None}
+        try:
+            with self.profiler.stage('page', sf.source):
+                self.language = get_language(sf.source, code, language=language)
+                if self.is_large(code):
+                    self.generate_large_pages(sf, code, self.language)
+                else:
+                    html = self.generate_documentation(sf.source, code, language=self.language)
+                    self.write_page(sf.source, sf.destination, html)
+            result['references'], result['anchors'] = self.references, self.anchors
+        except Exception as e:
+            result['error'] = str(e)
+
+        if self.streaming:
+            # Nothing of the page is kept once it is written.
+            self.sections = self.language = None
+            self.references, self.anchors = [], []
+        return result
+
+    def write_page(self, source, destination, html):
+        """ Hand the page of `source` over to the writer. The background writers time the \
+            writing themselves, here it is only the wait for room in their queue. """
+        stage = 'queue' if isinstance(self.output, BackgroundWriter) else 'write'
+        with self.profiler.stage(stage, source):
+            self.output.write(destination, html)
+
+    def is_large(self, code):
+        """ Check if the `code` (text or bytes) exceeds the `files: large:` thresholds """
+        size, lines = self.large_files['size'], self.large_files['lines']
+        if lines and code.count(b'\n' if isinstance(code, bytes) else u'\n') >= lines:
+            return True
+        if size:
+            return len(code if isinstance(code, bytes) else code.encode('utf8')) > size
+        return False
+
+    def generate_large_pages(self, sf, code, language):
+        """
+        ### Large files
+        Documenting a huge file in full may take longer than the rest of the project: Pygments \
+        lexes the whole file at once and the comment regular expressions scan it over and over. \
+        Files above the `size` (bytes) or `lines` thresholds of the `files: large:` config are \
+        handled according to its `mode`:
+
+          * `chunk` - split into pages of about `chunk-lines` lines, each one parsed and \
+            highlighted on its own: `file.py.html`, `file.py.2.html`, ...
+          * `plain` - shown on a single page as plain text, comments are not told from the code
+          * `copy` - copied verbatim, like the files matching `files: copy:`
+
+        Every such page starts with a note explaining why it looks different.
+        """
+        size = len(code.encode('utf8'))
+        lines = code.count('\n') + 1
+        note = "**Large file.** `{0}` has {1} lines ({2} bytes), more than the limits set in " \
+            "`files: large:` of the config. ".format(os.path.basename(sf.source), lines, size)
+
+        if self.large_files['mode'] == 'plain':
+            from xml.sax.saxutils import escape
+            self.references, self.anchors = [], []
+            section = Section(docs_text=note + "It is shown as plain text.", code_text=code, num=0,
+                              code_html=self.highlight_start + escape(code) + self.highlight_end)
+            section['docs_html'] = language.markdown(section['docs_text'])
+            with self.profiler.stage('render', sf.source):
+                html = self.generate_html(sf.source, [section])
+            self.write_page(sf.source, sf.destination, html)
+            return
+
+        chunks = list(split_chunks(code, self.large_files['chunk-lines']))
+        base, extension = os.path.splitext(sf.destination)
+        destinations = [sf.destination] + ["{0}.{1}{2}".format(base, i + 1, extension)
+                                           for i in range(1, len(chunks))]
+        references, anchors = [], []
+        for i, (first_line, chunk) in enumerate(chunks):
+            links = ["[{0}]({1})".format(title, os.path.basename(destinations[j]))
+                     for title, j in [("Previous page", i - 1), ("Next page", i + 1)]
+                     if 0 <= j < len(chunks)]
+            page_note = note + "It is split into {0} pages, this is page {1} (from line {2}). " \
+                .format(len(chunks), i + 1, first_line) + " ".join(links)
+
+            html = self.generate_documentation(sf.source, chunk, language=language,
+                                               note=page_note, first_line=first_line)
+            references.extend(self.references)
+            anchors.extend(self.anchors)
+            self.write_page(sf.source, destinations[i], html)
+        self.references, self.anchors = references, anchors
+
+    def __getstate__(self):
+        """ Worker processes receive everything but the page template, the loaded sources and \
+            the per-file state """
+        state = dict((k, v) for (k, v) in self.__dict__.items()
+                     if k not in ('page_template', 'loader', 'tree', 'output', 'profiler',
+                                  'language', 'parent', 'sections'))
+        state['config'] = self.config
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.page_template = self.template(self.page_template_source)
+        self.loader = SourceLoader(self.sourcedir, self.page_destination,
+                                   self.language_patterns)
+
+    def build_inputs(self, sf, code, css_contents):
+        """
+        ### Build inputs
+        Fingerprints of everything the page of `sf` depends on. If none of them changed since \
+        the last build, neither did the page.
+        """
+        config = dict((k, v) for (k, v) in self.config.items() if k != 'verbosity')
+        return {
+            "source":       digest(code),
+            "language":     self.language.name,
+            "config":       digest(json.dumps(config, sort_keys=True,
+                                              default=lambda x: getattr(x, 'pattern', repr(x)))),
+            "template":     digest(self.page_template_source) + digest(css_contents),
+            "navigation":   digest(json.dumps(self.generate_navigation(sf.source),
+                                              sort_keys=True)),
+            "version":      __version__,
+            # Where the page goes, so that it can be removed with its source
+            "destination":  os.path.relpath(sf.destination, self.outdir),
+        }
 
     def template(self, source):
-        return lambda context: pystache.render(source, context)
+        """ The page template, rendering a context into HTML """
+        def render(context):
+            import pystache
+            return pystache.render(source, context)
+        return render
 
-    def generate_documentation(self, source, code, language=None):
+    def generate_documentation(self, source, code, language=None, note=None, first_line=1):
         """
         ## Generating documentation
         Generate the documentation for a source file by reading it in, splitting it
         up into comment/code sections, highlighting them for the appropriate
         language, and merging them into an HTML template.
+
+        A part of a [large file](#large-files) starts at `first_line` and gets a `note` on top.
         """
+        self.generate_sections(source, code, language, note, first_line)
+        with self.profiler.stage('render', source):
+            return self.generate_html(source, self.sections)
+
+    def generate_sections(self, source, code, language, note=None, first_line=1):
+        """ Parse the `code` into `self.sections` with the highlighted code and rendered docs """
 
-        self.sections = language.parse(code, add_lineno=self.add_lineno)
-        language.preprocess(self.sections)
-        self.highlight(source, self.sections, language)
-        language.postprocess(self.sections)
-        return self.generate_html(source, self.sections)
+        # Cross-references and anchors are collected by `preprocess`
+        self.references, self.anchors = [], []
 
-    def highlight(self, source, sections, language):
+        # The token parser highlights the code while parsing it.
+        tokens = self.parser(language) == 'tokens'
+        with self.profiler.stage('parse', source):
+            if tokens:
+                self.sections = language.parse_tokens(code)
+            else:
+                self.sections = language.parse(code, add_lineno=self.add_lineno)
+        self.profiler.count(source, code, self.sections)
+        for section in self.sections:
+            section['line'] += first_line - 1
+        with self.profiler.stage('preprocess', source):
+            language.preprocess(self.sections)
+        if note:
+            self.sections.insert(0, Section(docs_text=note, code_text=""))
+        self.highlight(source, self.sections, language, highlighted=tokens)
+        with self.profiler.stage('postprocess', source):
+            language.postprocess(self.sections)
+        return self.sections
+
+    def parser(self, language):
+        """ The parse engine of the `language`, `"regex"` or `"tokens"` """
+        parsers = self.config['documentation'].get('parsers') or {}
+        return parsers.get(language.name, language.parser)
+
+    def highlight(self, source, sections, language, highlighted=False):
         """
         ### Highlighting the source code
 
@@ -372,23 +994,29 @@ class Pyccoon(object):
 
         We process the entire file in a single call to Pygments by inserting little
         marker comments between each section and then splitting the result string
-        wherever our markers occur.
+        wherever our markers occur. The code of the sections is `highlighted` already by
+        the token parser.
         """
-        output = language.highlight(
-            language.divider_text.join(section["code_text"].rstrip() for section in sections)
-        )
+        if not highlighted:
+            with self.profiler.stage('highlight', source):
+                output = language.highlight(
+                    language.divider_text.join(section["code_text"].rstrip()
+                                               for section in sections)
+                )
 
-        output = output.replace(self.highlight_start, "").replace(self.highlight_end, "")
-        fragments = re.split(language.divider_html, output)
+            output = output.replace(self.highlight_start, "").replace(self.highlight_end, "")
+            fragments = re.split(language.divider_html, output)
         for i, section in enumerate(sections):
-            section["code_html"] = shift(fragments, "")
+            if not highlighted:
+                section["code_html"] = shift(fragments, "")
             if section["code_html"]:
                 section["code_html"] = \
                     self.highlight_start + section["code_html"] + self.highlight_end
             docs_text = section["docs_text"]
-            section["docs_html"] = language.markdown(
-                self.preprocess(docs_text, source=os.path.join(self.sourcedir, source))
-            )
+            with self.profiler.stage('preprocess', source):
+                docs_text = self.preprocess(docs_text, source=os.path.join(self.sourcedir, source))
+            with self.profiler.stage('markdown', source):
+                section["docs_html"] = language.markdown(docs_text)
             section["num"] = i
 
     def preprocess(self, comment, source):
@@ -427,28 +1055,31 @@ class Pyccoon(object):
                 if anchor:
                     name = name + '#' + anchor
 
-            anchor = '#' + anchor if anchor else ''
-
             if not path.startswith('.'):
                 # Absolute reference
-                path = os.path.relpath(
-                    self.destination(path),
-                    os.path.split(self.sources[os.path.relpath(source,
-                                                               self.sourcedir)].destination)[0]
-                )
+                target = path
             else:
                 # Relative reference
-                path = os.path.relpath(
-                    self.destination(os.path.join(
-                        os.path.split(os.path.relpath(source, self.sourcedir))[0], path)
-                    ),
-                    os.path.split(self.sources[os.path.relpath(source,
-                                                               self.sourcedir)].destination)[0]
-                )
+                target = os.path.normpath(os.path.join(
+                    os.path.split(os.path.relpath(source, self.sourcedir))[0], path))
+
+            # The link depends on where the target page is, see
+            # [[manifest.py#cross-reference-dependencies]]
+            destination = self.destination(target)
+            self.references.append((target, anchor, destination))
+
+            anchor = '#' + anchor if anchor else ''
+
+            path = os.path.relpath(
+                destination,
+                os.path.split(self.sources[os.path.relpath(source,
+                                                           self.sourcedir)].destination)[0]
+            )
 
             return "[{0:s}]({1:s}{2:s})".format(name, path, anchor)
 
         def replace_section_name(match):
+            self.anchors.append(slugify(match.group(3)))
             return (
                     '\n{lvl} <a id="{id}" class="header-anchor" href="#{id}">{name}</a>'
             ).format(**{
@@ -649,7 +1280,11 @@ class Pyccoon(object):
         return language
 
     def template(self, source):
-        return lambda context: pystache.render(source, context)
+        """ The page template, rendering a context into HTML """
+        def render(context):
+            import pystache
+            return pystache.render(source, context)
+        return render
 
     
     # ## HTML Code generation
@@ -675,6 +1310,7 @@ class Pyccoon(object):
         breadcrumbs, filename = self.generate_breadcrumbs(dest, title)
         children = self.generate_navigation(source)
         contents = self.generate_contents(sections)
+        generation_time = self.generation_time or datetime.now()
 
         for section in sections:
             section['line_count'] = (section['code_text'].rstrip('\n') + '\n').count('\n')
@@ -692,7 +1328,7 @@ class Pyccoon(object):
             "contents":         contents,
             "contents?":        bool(contents),
             "destination":      dest,
-            "generation_time":  datetime.now().strftime('%Y-%m-%d %H:%M'),
+            "generation_time":  generation_time.strftime('%Y-%m-%d %H:%M'),
             "root_path":        os.path.relpath(".", os.path.split(source)[0]),
             "project_name":     self.project_name,
             "mathjax?":          self.config['documentation']['mathjax'],
@@ -746,8 +1382,9 @@ class Pyccoon(object):
         folder = os.path.split(os.path.join(self.sourcedir, source))[0]
         relfolder = os.path.relpath(folder, self.sourcedir)
         outfolder = os.path.join(self.outdir, relfolder) if relfolder != "." else self.outdir
-        for filename in os.listdir(folder):
-            if not any([regex.search(filename) for regex in self.config['files']['skip']]):
+        # Sorted, as the order of `os.listdir` depends on the file system.
+        for filename in sorted(os.listdir(folder)):
+            if not self.skip_re.search(filename):
                 isdir = False
                 filepath = None
 
@@ -804,10 +1441,14 @@ class Pyccoon(object):
         source is `lib/example.py`, the HTML will be at `docs/lib/example.html`
         """
 
-        dirname, filename = os.path.split(source)
-        if process:
-            language = language or self.get_language(source)
+        if process and not language:
+            return self.loader.resolve(source).destination
+
+        return self.page_destination(source, language if process else None)
 
+    def page_destination(self, source, language):
+        """ Destination path of the `source` page for the already known `language` """
+        dirname, filename = os.path.split(source)
         name = language.transform_filename(filename) if language else filename
         return os.path.normpath(os.path.join(self.outdir, os.path.join(dirname, name)))
 
@@ -816,10 +1457,7 @@ class Pyccoon(object):
         language = None
 
         try:
-            with open(os.path.join(self.sourcedir, source), "rb") as sourcefile:
-                code = sourcefile.read().decode('utf8')
-
-            language = get_language(source, code)
+            language = self.loader.resolve(source).language
             language.parent = self
             language.root = self.sourcedir
             language.source = source
@@ -829,21 +1467,114 @@ class Pyccoon(object):
         return language
 
 
+# ## Worker processes
+#
+# With `jobs` > 1 every worker process keeps its own copy of the `Pyccoon` instance.
+
+_worker = None
+
+
+def _init_worker(pyccoon):
+    global _worker
+    _worker = pyccoon
+    # The writer threads of the parent are not running here, the worker writes its pages itself,
+    # unless they go to the archive of the parent.
+    # Workers compress their pages themselves, they run in parallel already.
+    _worker.output = MemoryWriter() if pyccoon.archive else \
+        OutputWriter(pyccoon.compare,
+                     Precompressor(pyccoon.precompress, threads=0) if pyccoon.precompress else None)
+    _worker.profiler = Profiler() if pyccoon.profile else NoProfiler()
+
+
+def _generate_page(page):
+    sf, code, _ = page
+    # The worker does not need to read the file again to learn its destination.
+    _worker.loader.add(sf.source, code)
+    output = _worker.output
+    files, changed = output.files, output.changed
+    result = _worker.generate_page(*page)
+    # Report the written files to the parent process.
+    result['output'] = (output.files - files, output.changed - changed)
+    if _worker.archive:
+        result['files'] = output.take()
+    result['profile'] = _worker.profiler.take()
+    return result
+
+
 def main():
     """Hook spot for the console script."""
 
-    parser = optparse.OptionParser(version='Pyccoon {0}'.format(__version__))
+    # Commands besides the plain build:
+    #
+    # - `pyccoon merge [options] SHARD...` combines the outputs of `--shard` builds
+    # - `pyccoon serve [options]` renders the pages on demand over HTTP, see [[server.py]]
+    # - `pyccoon serve --daemon [options]` runs the [[daemon.py]]
+    # - `pyccoon client [options] COMMAND [PATH...]` sends a request to the daemon
+    commands = {
+        'merge':    '%prog merge [options] SHARD...',
+        'serve':    '%prog serve [--daemon] [options]',
+        'client':   '%prog client [options] build|render|ping|stop [PATH...]',
+    }
+    command = sys.argv[1] if sys.argv[1:2] and sys.argv[1] in commands else None
+
+    parser = optparse.OptionParser(version='Pyccoon {0}'.format(__version__),
+                                   usage=commands.get(command))
     parser.add_option('-s', '--source', action='store', type='string',
                       dest='sourcedir', default='.',
                       help='Source files directory (default: `%default`)')
 
     parser.add_option('-d', '--destination', action='store', type='string',
                       dest='outdir', default='docs',
-                      help='Output directory (default: `%default`)')
+                      help='Output directory, or a .zip, .tar, .tar.gz, .tgz, .tar.bz2 or .tar.xz '
+                           'archive to write everything into, .tar.xz needs Python 3 '
+                           '(default: `%default`)')
 
     parser.add_option('-w', '--watch', action='store_true',
                       help='Watch original files and regenerate documentation on changes')
 
+    parser.add_option('-i', '--incremental', action='store_true',
+                      help='Only regenerate the documentation of files changed since the last '
+                           'build')
+
+    parser.add_option('--since', action='store', dest='since', type='string',
+                      help='Only regenerate the files changed in the git repository since the '
+                           'given revision, and remove the outputs of the deleted ones. Needs '
+                           '--incremental')
+
+    parser.add_option('-j', '--jobs', action='store', dest='jobs',
+                      default=1, type='int',
+                      help='Number of processes generating the pages in parallel '
+                           '(default: %default)')
+
+    parser.add_option('--writers', action='store', dest='writers',
+                      default=2, type='int',
+                      help='Number of threads writing the files in the background, 0 to write '
+                           'them right away (default: %default)')
+
+    parser.add_option('--compare', action='store_true',
+                      help='Only write the files whose contents changed, keeping the modification '
+                           'time of the others')
+
+    parser.add_option('--precompress', action='store', dest='precompress', type='string',
+                      help='Comma-separated compressed variants to write next to the HTML and CSS '
+                           'files: gz, br (needs the brotli package); implies --compare')
+
+    parser.add_option('--streaming', action='store_true',
+                      help='Keep nothing of a file in memory once its page is written, for '
+                           'huge projects')
+
+    parser.add_option('-r', '--reproducible', action='store_true',
+                      help='Generate identical output from identical sources, using '
+                           'SOURCE_DATE_EPOCH or the newest source file as the generation time')
+
+    parser.add_option('--profile', action='store', dest='profile', type='string',
+                      help='Time every stage of the build and write a JSON report to the given '
+                           'file, with a Chrome trace next to it')
+
+    parser.add_option('--profile-top', action='store', dest='profile_top',
+                      default=10, type='int',
+                      help='Number of the slowest files listed in the profile (default: %default)')
+
     parser.add_option('-c', '--config', action='store', dest='config_file',
                       default=os.path.join(os.getcwd(), '.pyccoon.yaml'), type='string',
                       help='Config file to use (default: `%default`)')
@@ -852,10 +1583,69 @@ def main():
                       default=-1, type='int',
                       help='Terminal output verbosity (0 to 1; default: %default)')
 
-    opts, _ = parser.parse_args()
+    parser.add_option('--shard', action='store', dest='shard', type='string',
+                      help='Render only the K-th of N parts of the pages, given as K/N; combine '
+                           'the parts with `pyccoon merge`')
+
+    parser.add_option('--daemon', action='store_true',
+                      help='With `serve`: keep running and answer the build and render requests '
+                           'on a Unix socket')
+
+    parser.add_option('--socket', action='store', dest='socket', type='string',
+                      help='Unix socket of the daemon (default: derived from the source directory)')
+
+    parser.add_option('--port', action='store', dest='port', default=8000, type='int',
+                      help='With `serve`: port of the development server (default: %default)')
+
+    parser.add_option('--cache-size', action='store', dest='cache_size', default=64, type='int',
+                      help='With `serve`: megabytes of rendered pages kept in memory '
+                           '(default: %default)')
+
+    opts, args = parser.parse_args(sys.argv[2:] if command else sys.argv[1:])
     opts = defaultdict(lambda: None, vars(opts))
 
-    Pyccoon(opts)
+    if command == 'merge':
+        if not args:
+            parser.error('No shard folders to merge')
+        Pyccoon(opts, process=False).merge(args)
+
+    elif command == 'serve' and opts['daemon']:
+        from .daemon import Daemon, default_socket
+        pyccoon = Pyccoon(opts)
+        Daemon(pyccoon, opts['socket'] or default_socket(pyccoon.sourcedir)).serve()
+
+    elif command == 'serve':
+        from .server import DevServer
+        DevServer(Pyccoon(opts, process=False), ('127.0.0.1', opts['port']),
+                  cache_size=opts['cache_size'] * 1024 * 1024).serve()
+
+    elif command == 'client':
+        from .daemon import request, default_socket
+        if not args:
+            parser.error('No command to send')
+        message = {'command': args[0]}
+        if args[0] == 'build':
+            message['paths'] = [os.path.abspath(path) for path in args[1:]]
+        elif args[0] == 'render':
+            if len(args) != 2:
+                parser.error('`render` needs a single path')
+            message['path'] = os.path.abspath(args[1])
+        response = request(opts['socket'] or default_socket(opts['sourcedir']), message)
+        if not response['ok']:
+            sys.exit(response['error'])
+        if 'html' in response:
+            print(response['html'])
+        else:
+            print(json.dumps(response, sort_keys=True))
+
+    elif opts['since']:
+        if not opts['incremental']:
+            parser.error('--since needs --incremental, the manifest of the previous build '
+                         'tells which pages link to the changed files')
+        Pyccoon(opts, process=False).process_since(opts['since'])
+
+    else:
+        Pyccoon(opts)
 
 # Run the script.
 if __name__ == "__main__":
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+"""
+## Rendering in memory
+
+For services that show annotated sources, e.g. a code review tool, nothing has to be walked or \
+written:
+
+    from pyccoon import render, render_many
+
+    html = render("lib/example.py", code)
+    sections = render("lib/example.py", code, sections=True)
+    pages = render_many([("a.py", code_a), ("b.rb", code_b)], threads=4)
+
+The language is found by the extension or the name of the path, or sniffed and guessed from \
+the code, unless it is given by its name (`"Python"`) or as a `Language` instance. `config` \
+takes the same keys as `.pyccoon.yaml`; the paths of a custom CSS file or HTML template are not \
+read, the template is given as a string instead.
+
+The functions are thread-safe and touch no files. Lexers are shared by all the pages and the \
+Markdown converters are built once per thread, so a batch is much cheaper than the same number \
+of single calls with a new `Renderer` each.
+"""
+
+import os
+
+from . import resources
+from .pyccoon import Pyccoon, default_config
+from .languages import Language, get_language, get_language_by_extension
+from .utils import SourceFile
+
+
+class Renderer(Pyccoon):
+
+    """
+    A `Pyccoon` without a source or an output folder: pages are rendered from the given code \
+    and returned. Cross-references are linked as if all files were in a single project.
+    """
+
+    verbosity = 0
+
+    def __init__(self, config=None, template=None, generation_time=None):
+        """
+        :param config: `dict` of settings, as in `.pyccoon.yaml`
+        :param template: Mustache source of the page template, the default one if `None`
+        :param generation_time: `datetime` shown on the pages, the time of rendering if `None`
+        """
+        self.config = dict((key, dict(value) if isinstance(value, dict) else value)
+                           for key, value in default_config.items())
+        for key, value in (config or {}).items():
+            if isinstance(value, dict) and isinstance(self.config.get(key), dict):
+                self.config[key].update(value)
+            else:
+                self.config[key] = value
+
+        self.project_name = self.config['project']['name'] or "Documentation"
+        self.linebreaking_behavior = self.config['documentation']['linebreaking-behavior']
+        self.custom_css_path = self.custom_html_template_path = None
+        self.generation_time = generation_time
+
+        self.page_template_source = template or resources.html
+        self.page_template = self.template(self.page_template_source)
+        self.sources = {}
+
+    def page(self, path):
+        """ A copy holding the state of a single page, so that pages render concurrently """
+        page = object.__new__(self.__class__)
+        page.__dict__.update(self.__dict__)
+        # Paths are relative to the working directory, as in a project built from there.
+        page.sourcedir = page.outdir = os.getcwd()
+        page.sources = {path: SourceFile(source=path, destination=page.destination(path))}
+        return page
+
+    def language_of(self, path, code, language=None):
+        """ The `Language` of the `path`, or a `ValueError` if it is unknown """
+        if isinstance(language, Language):
+            return language
+        language = get_language(path, code, language)
+        if not language:
+            raise ValueError("Unknown language of {0}".format(path))
+        return language
+
+    def render(self, path, code, language=None, sections=False):
+        """
+        Return the HTML page of the `code` of the file at the relative `path`, or the list of \
+        its sections if `sections` is true. Every section has the `docs_text`, `docs_html`, \
+        `code_text`, `code_html`, `line` and `num` keys.
+        """
+        path = os.path.normpath(path)
+        language = self.language_of(path, code, language)
+        page = self.page(path)
+        if sections:
+            return [dict(section) for section in
+                    page.generate_sections(path, code, language)]
+        return page.generate_documentation(path, code, language=language)
+
+    def render_many(self, files, language=None, sections=False, threads=1):
+        """ Render the `(path, code)` pairs of `files` in order, in a pool of `threads` """
+        files = list(files)
+        if threads <= 1 or len(files) < 2:
+            return [self.render(path, code, language, sections) for path, code in files]
+
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(threads)
+        try:
+            return pool.map(lambda page: self.render(page[0], page[1], language, sections), files)
+        finally:
+            pool.close()
+
+    # Nothing is read from the disk: the language of a linked file is known by its extension
+    # and the index pages have no folder listing.
+
+    def destination(self, source, language=None, process=True):
+        if process:
+            language = language or get_language_by_extension(source)
+        return self.page_destination(source, language if process else None)
+
+    def get_language(self, source):
+        return get_language_by_extension(source)
+
+    def generate_navigation(self, source):
+        return []
+
+
+def render(path, code, language=None, config=None, sections=False):
+    """ Render a single file in memory, see `Renderer.render` """
+    return Renderer(config).render(path, code, language, sections)
+
+
+def render_many(files, language=None, config=None, sections=False, threads=1):
+    """ Render the `(path, code)` pairs of `files` in memory, see `Renderer.render_many` """
+    return Renderer(config).render_many(files, language, sections, threads)
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""
+## Development server
+
+    pyccoon serve -s src -d docs --port 8000
+
+serves the documentation without generating it first. A page is rendered only when the browser \
+asks for it: the requested path is looked up among the destinations of the sources (see \
+`Pyccoon.destination`), and folder index pages are built from the in-memory source tree. \
+Nothing is written to the output folder.
+
+Rendered pages are kept in a `PageCache` of limited size. A page is rendered again when the \
+modification time or the size of its source changes.
+
+The sources are collected again only when a page of a source folder that changed since is \
+requested (new, deleted or renamed files change the stamp of their folder), so that missing files \
+(`/favicon.ico`, typos, crawlers) are cheap. As pages list and link to the other sources, all the \
+cached pages are rendered again after that.
+"""
+
+import os
+import mimetypes
+from collections import OrderedDict
+from io import open
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+try:
+    from urllib.parse import unquote, urlparse
+except ImportError:
+    from urllib import unquote
+    from urlparse import urlparse
+
+from . import resources
+from .languages import Language
+
+
+class PageCache(object):
+
+    """
+    Rendered pages with the stamps of their sources. When the pages take more than `size` \
+    bytes, the least recently used ones are dropped.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.used = 0
+        self.pages = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key, stamp):
+        """ The page stored under `key`, unless it is missing or its `stamp` changed """
+        entry = self.pages.pop(key, None)
+        if entry is not None and entry[0] == stamp:
+            self.pages[key] = entry
+            self.hits += 1
+            return entry[1]
+        if entry is not None:
+            self.used -= len(entry[1])
+        self.misses += 1
+
+    def put(self, key, stamp, data):
+        old = self.pages.pop(key, None)
+        if old is not None:
+            self.used -= len(old[1])
+        if len(data) > self.size:
+            return
+        self.pages[key] = (stamp, data)
+        self.used += len(data)
+        while self.used > self.size:
+            _, (_, dropped) = self.pages.popitem(last=False)
+            self.used -= len(dropped)
+
+
+def stamp(path):
+    """ Modification time and size of the file at `path`, or `None` """
+    try:
+        st = os.stat(path)
+        return st.st_mtime, st.st_size
+    except OSError:
+        return None
+
+
+class DevServerHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = unquote(urlparse(self.path).path)
+        try:
+            page = self.server.page(path)
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+        if page is None:
+            self.send_error(404)
+            return
+
+        data, content_type = page
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        self.server.pyccoon.log(format % args)
+
+
+class DevServer(HTTPServer):
+
+    """ Serves the documentation of `pyccoon` rendered on demand, at `address` """
+
+    def __init__(self, pyccoon, address, cache_size=64 * 1024 * 1024):
+        self.pyccoon = pyccoon
+        self.cache = PageCache(cache_size)
+        # Number of times the sources were collected, part of the stamps of the cached pages
+        self.generation = 0
+        folder = os.path.dirname(os.path.abspath(resources.__file__))
+        self.static = dict((os.path.join(pyccoon.outdir, dest), os.path.join(folder, filename))
+                           for filename, dest in resources.static_files)
+        self.collect()
+        HTTPServer.__init__(self, address, DevServerHandler)
+
+    def collect(self):
+        """ Find the sources anew and map the destinations to them. Only the first bytes of the \
+            files are read, the rest when their pages are requested. """
+        pyccoon = self.pyccoon
+        pyccoon.collect_sources(peek=True)
+        self.generation += 1
+        self.destinations = dict((sf.destination, sf) for sf in pyccoon.sources.values())
+        # Stamps of the source folders, new files change the stamp of their folder
+        self.folders = dict((folder, stamp(os.path.join(pyccoon.sourcedir, folder)))
+                            for folder in pyccoon.tree.folders)
+
+    def serve(self):
+        self.pyccoon.log("Serving at http://{0}:{1}/".format(*self.server_address[:2]))
+        try:
+            self.serve_forever()
+        finally:
+            self.server_close()
+
+    def page(self, path, retry=True):
+        """ Return `(data, content type)` of the URL `path`, or `None` if there is no such page """
+        outdir = self.pyccoon.outdir
+        destination = os.path.normpath(os.path.join(outdir, path.lstrip('/')))
+        if destination != outdir and not destination.startswith(outdir + os.sep):
+            return None
+        if path.endswith('/') or destination == outdir:
+            destination = os.path.join(destination, 'index.html')
+
+        content_type = mimetypes.guess_type(destination)[0] or 'application/octet-stream'
+        if content_type.startswith('text/'):
+            content_type += '; charset=utf-8'
+
+        if destination == os.path.join(outdir, resources.css_filename):
+            return self.pyccoon.stylesheet().encode('utf8'), content_type
+
+        if destination in self.static:
+            return self.read(self.static[destination]), content_type
+
+        # The files of the folder may have changed since the sources were collected.
+        folder = os.path.relpath(os.path.dirname(destination), outdir)
+        folder = '' if folder == '.' else folder
+        changed = stamp(os.path.join(self.pyccoon.sourcedir, folder)) != self.folders.get(folder)
+        if retry and changed:
+            self.collect()
+            return self.page(path, retry=False)
+
+        sf = self.destinations.get(destination)
+        if sf is not None:
+            source = os.path.join(self.pyccoon.sourcedir, sf.source)
+            if not sf.process or self.pyccoon.loader.resolve(sf.source).language is None:
+                return self.read(source), content_type
+            return self.rendered(destination, stamp(source),
+                                 lambda: self.pyccoon.render_page(sf.source)), content_type
+
+        if os.path.basename(destination) == 'index.html' and folder in self.pyccoon.tree.folders:
+            return self.rendered(destination, self.folders.get(folder),
+                                 lambda: self.index_page(folder)), content_type
+
+    def rendered(self, key, stamp, render):
+        """ The cached page `key`, rendered anew if its source `stamp` changed or the sources \
+            were collected again """
+        stamp = (self.generation, stamp)
+        data = self.cache.get(key, stamp)
+        if data is None:
+            data = render().encode('utf8')
+            self.cache.put(key, stamp, data)
+        return data
+
+    def index_page(self, folder):
+        """ Generated index page of a `folder` without its own index file """
+        self.pyccoon.language = Language()
+        return self.pyccoon.generate_html(os.path.join(folder, 'index.html'), [])
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+"""
+## Source loading
+
+During a single build the same source file is needed in several places: to tell binary files \
+from text, to detect the language, to compute the destination path (also for every \
+cross-reference pointing to it) and finally to generate its documentation.
+
+`SourceLoader` reads each file once and keeps a `SourceRecord` with the contents and everything \
+derived from them, so that all these places share it.
+
+Language and destination of a file are also remembered between the builds (e.g., in the `watch` \
+mode) for as long as the modification time and the size of the file stay the same.
+"""
+
+import os
+import fnmatch
+from io import open
+from collections import namedtuple
+
+from .languages import get_language_by_extension, get_language_by_filename, sniff_language, \
+    guess_language, guess_prefix_size, find_language
+from .utils import cached_property, digest, is_binary_string
+
+
+Resolution = namedtuple('Resolution', 'language destination')
+
+
+class SourceRecord(object):
+
+    """ Contents of a single source file and the data derived from them """
+
+    # Binary files are recognized by this many first bytes and never read further.
+    prefix_size = 1024
+
+    def __init__(self, loader, source, text=None, peek=False):
+        self.loader = loader
+        self.source = source
+        self.error = None
+        self.prefix = self.data = None
+        self.binary = False
+
+        # The contents may be already known, then there is nothing to read.
+        if text is not None:
+            self.text = text
+            self.data = text.encode('utf8')
+            self.prefix = self.data[:self.prefix_size]
+            return
+
+        self.read(peek)
+
+    def read(self, peek=False):
+        """ Read the file, or only its `prefix` when peeking """
+        try:
+            with open(os.path.join(self.loader.sourcedir, self.source), 'rb') as f:
+                self.prefix = f.read(self.prefix_size)
+                self.binary = is_binary_string(self.prefix)
+                if not self.binary and not peek:
+                    self.data = self.prefix + f.read()
+        except (IOError, OSError) as e:
+            self.error = e
+
+    @property
+    def peeked(self):
+        """ Only the `prefix` of a text file was read so far """
+        return self.data is None and not self.binary and not self.error
+
+    @cached_property
+    def text(self):
+        """ Decoded contents of the file """
+        if self.peeked:
+            self.read()
+        if self.error:
+            raise self.error
+        if self.binary:
+            raise ValueError("Binary file: {0:s}".format(self.source))
+        return self.data.decode('utf8')
+
+    @cached_property
+    def guessed_language(self):
+        """ Language sniffed or guessed from the contents, or `None` if it cannot be determined. \
+            Files starting the same way get the same guess within a build. """
+        try:
+            language = sniff_language(self.text)
+            if language:
+                return language
+            key = digest(self.text[:guess_prefix_size])
+            if key not in self.loader.guesses:
+                self.loader.guesses[key] = guess_language(self.text)
+            return self.loader.guesses[key]
+        except Exception:
+            return None
+
+    @property
+    def language(self):
+        return self.loader.resolve(self.source).language
+
+    @property
+    def destination(self):
+        """ Destination path of the documentation page """
+        return self.loader.resolve(self.source).destination
+
+
+class SourceLoader(object):
+
+    """
+    Cache of `SourceRecord`s for the current build.
+
+    :param sourcedir: Project source directory
+    :param destination: Function computing the destination path from the source path and language
+    :param patterns: `(glob, language name)` pairs of the `files: languages:` config, matched \
+        against the file names and the paths relative to the `sourcedir`
+    """
+
+    def __init__(self, sourcedir, destination, patterns=()):
+        self.sourcedir = sourcedir
+        self.destination = destination
+        self.patterns = list(patterns)
+        self.records = {}
+        self.stats = {}
+        self.resolved = {}
+        self.guesses = {}
+
+    def load(self, source, peek=False):
+        """ Return the record of the `source` file, reading it if this is the first request. \
+            With `peek`, only the first bytes are read until the contents are needed. """
+        record = self.records.get(source)
+        if record is None:
+            record = self.records[source] = SourceRecord(self, source, peek=peek)
+        elif record.peeked and not peek:
+            record.read()
+        return record
+
+    def add(self, source, text):
+        """ Register the already decoded `text` of the `source` file, unless it was read before """
+        if source not in self.records:
+            self.records[source] = SourceRecord(self, source, text=text)
+        return self.records[source]
+
+    def forget(self, source):
+        """ Drop the record of the `source` file, its language and destination stay resolved """
+        self.records.pop(source, None)
+
+    def stat(self, source):
+        """ `(mtime, size)` of the `source` file or `None` if it does not exist. The file system \
+            is asked only once per build. """
+        if source not in self.stats:
+            try:
+                st = os.stat(os.path.join(self.sourcedir, source))
+                self.stats[source] = (st.st_mtime, st.st_size)
+            except OSError:
+                self.stats[source] = None
+        return self.stats[source]
+
+    def resolve(self, source):
+        """
+        ### Language and destination resolution
+        Return the `Resolution` of the `source` file: its language and the destination path.
+
+        Files matching the `patterns`, with a known extension or a well-known name are resolved \
+        without being read. Otherwise the language is sniffed or guessed from the contents, and \
+        the result is remembered even if there is no language (a negative entry), until the \
+        file is modified.
+        """
+        key = self.stat(source)
+        cached = self.resolved.get(source)
+        if cached and cached[0] == key:
+            return cached[1]
+
+        language = None
+        if key is not None:
+            language = self.match(source) or get_language_by_extension(source) or \
+                get_language_by_filename(source) or self.load(source).guessed_language
+
+        resolution = Resolution(language, self.destination(source, language))
+        self.resolved[source] = (key, resolution)
+        return resolution
+
+    def match(self, source):
+        """ The language of the first of the `patterns` matching the `source` path """
+        path = source.replace(os.sep, '/')
+        name = os.path.basename(source)
+        for pattern, language in self.patterns:
+            if fnmatch.fnmatchcase(name, pattern) or fnmatch.fnmatchcase(path, pattern):
+                return find_language(language)
+
+    def clear(self):
+        """ Forget everything that was read. Called between the builds. """
+        self.records = {}
+        self.stats = {}
+        self.guesses = {}
+
+
+# ## Source tree
+
+class SourceTree(object):
+
+    """
+    Folders of the output directory with their files and subfolders, built once from the \
+    destinations of all sources. It tells which folders still need a generated `index.html` \
+    without comparing every source with every other one.
+    """
+
+    index_name = 'index.html'
+
+    def __init__(self, outdir):
+        self.outdir = outdir
+        self.folders = {}
+        self.folder('')
+
+    def folder(self, path):
+        """ Return the node of the folder `path` (relative to `outdir`), creating its chain """
+        node = self.folders.get(path)
+        if node is None:
+            node = self.folders[path] = {'files': set(), 'folders': set(), 'index': False}
+            if path:
+                parent, name = os.path.split(path)
+                self.folder(parent)['folders'].add(name)
+        return node
+
+    def add(self, destination):
+        """ Register an output file by its absolute `destination` path """
+        path = os.path.relpath(destination, self.outdir)
+        folder, name = os.path.split(path)
+        node = self.folder(folder)
+        node['files'].add(name)
+        if name == self.index_name:
+            node['index'] = True
+
+    def children(self, path):
+        """ Names of subfolders and files of the folder `path` """
+        node = self.folders[path]
+        return sorted(node['folders']), sorted(node['files'])
+
+    def missing_indexes(self):
+        """ Folders that do not have an index file yet, parents first """
+        return sorted(path for path, node in self.folders.items() if not node['index'])
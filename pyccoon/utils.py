@@ -1,7 +1,20 @@
 import os
+import re
 import time
+import threading
+import hashlib
 from collections import namedtuple
 
+# `os.scandir` appeared in Python 3.5; older versions may have the `scandir` package. Without it,
+# `walk` falls back to `os.listdir` and a `stat` call for every entry.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 
 class SourceFile(namedtuple('SourceFile', 'destination source process prefix')):
     def __new__(cls, destination, source, process=True, prefix=None):
@@ -45,6 +58,86 @@ def shift(array, default):
         return default
 
 
+_textchars = bytearray([7, 8, 9, 10, 12, 13, 27]) + bytearray(range(0x20, 0x100))
+
+
+def is_binary_string(data):
+    """ Check if the `data` bytes contain any characters that do not occur in text """
+    return bool(data.translate(None, _textchars))
+
+
+def digest(data):
+    """ SHA-1 hex digest of a byte or text string """
+    if not isinstance(data, bytes):
+        data = data.encode('utf8')
+    return hashlib.sha1(data).hexdigest()
+
+
+def combine_patterns(patterns):
+    """ Compile a list of regular expressions into a single alternation. An empty list gives \
+        an expression that never matches. """
+    if not patterns:
+        return re.compile(r"(?!)")
+    return re.compile("|".join("(?:{0})".format(getattr(p, 'pattern', p)) for p in patterns))
+
+
+def walk(top, skip):
+    """
+    ### Walking the folders
+    Like `os.walk`, yield `(dirpath, filenames)` for the `top` folder and its subfolders, but \
+    never descend into the folders for which `skip(path)` is true. Symbolic links to folders are \
+    not followed. Entry types reported by `scandir` save a `stat` call per entry.
+    """
+    folders = [top]
+    while folders:
+        dirpath = folders.pop()
+        subfolders, files = [], []
+
+        try:
+            if scandir:
+                for entry in scandir(dirpath):
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            subfolders.append(entry.name)
+                    else:
+                        files.append(entry.name)
+            else:
+                for name in os.listdir(dirpath):
+                    path = os.path.join(dirpath, name)
+                    if os.path.isdir(path):
+                        if not os.path.islink(path):
+                            subfolders.append(name)
+                    else:
+                        files.append(name)
+        except OSError:
+            continue
+
+        yield dirpath, files
+
+        for name in sorted(subfolders, reverse=True):
+            path = os.path.join(dirpath, name)
+            if not skip(path):
+                folders.append(path)
+
+
+def split_chunks(text, size):
+    """
+    Split the `text` into chunks of about `size` lines and yield `(first line number, chunk)`. \
+    A chunk ends at the first blank line after `size` lines, so that comments and definitions \
+    are less likely to be cut in half, but it is never longer than `2 * size` lines.
+    """
+    lines = text.split('\n')
+    start = 0
+    while start < len(lines):
+        end = min(start + size, len(lines))
+        limit = min(start + 2 * size, len(lines))
+        while end < limit and lines[end - 1].strip():
+            end += 1
+        chunk = '\n'.join(lines[start:end])
+        yield start + 1, chunk + '\n' if end < len(lines) else chunk
+        start = end
+
+
 def ensure_directory(directory):
     """ ### Ensure directory
         Ensure that the destination directory exists."""
@@ -53,8 +146,15 @@ def ensure_directory(directory):
         os.makedirs(directory)
 
 
-def monitor(path, file_modified, file_changed):
-    """Monitor each source file and re-generate documentation on change."""
+def monitor(path, file_modified, file_changed, delay=0.5):
+    """
+    Monitor each source file and re-generate documentation on change.
+
+    Editors and `git checkout` tend to produce bursts of events, so the events are collected \
+    until there are none for `delay` seconds. Then either `file_modified(paths)` is called with \
+    all the modified paths (relative to `path`), or `file_changed(paths)` if some files or \
+    folders were also created, deleted or moved.
+    """
 
     # The watchdog modules are imported in `main()` but we need to re-import
     # here to bring them into the local namespace.
@@ -63,6 +163,12 @@ def monitor(path, file_modified, file_changed):
 
     path = os.path.normpath(path)
 
+    # Pending paths mapped to whether they were created, deleted or moved,
+    # and the time of the last event.
+    pending = {}
+    last_event = [0]
+    lock = threading.Lock()
+
     class RegenerateHandler(watchdog.events.FileSystemEventHandler):
         """A handler for recompiling files which triggered watchdog events"""
 
@@ -73,23 +179,30 @@ def monitor(path, file_modified, file_changed):
                     for f in os.path.relpath(event.src_path, path).split(os.sep)]):
                 return
 
-            task = None
-            if event.event_type == "modified":
-                if not event.is_directory:
-                    task = file_modified
-                else:
-                    return
-            else:
-                task = file_changed
+            if event.event_type == "modified" and event.is_directory:
+                return
+
+            # Merely opening a file changes nothing
+            if event.event_type in ("opened", "closed_no_write"):
+                return
+
+            paths = [event.src_path]
+            if event.event_type == "moved":
+                paths.append(event.dest_path)
 
-            if task:
-                print("\n")
-                print("{} \"{}\" was {}, generating documentation...".format(
-                    "Directory" if event.is_directory else "File",
-                    event.src_path,
-                    event.event_type
-                ))
-                task()
+            print("\n")
+            print("{} \"{}\" was {}, generating documentation...".format(
+                "Directory" if event.is_directory else "File",
+                event.src_path,
+                event.event_type
+            ))
+
+            with lock:
+                for src_path in paths:
+                    source = os.path.relpath(src_path, path)
+                    pending[source] = pending.get(source) \
+                        or event.event_type in ("created", "deleted", "moved")
+                last_event[0] = time.time()
 
     # Set up an observer which monitors all directories for files given on
     # the command line and notifies the handler defined above.
@@ -101,7 +214,18 @@ def monitor(path, file_modified, file_changed):
     observer.start()
     try:
         while True:
-            time.sleep(1)
+            time.sleep(delay / 5)
+
+            with lock:
+                if not pending or time.time() - last_event[0] < delay:
+                    continue
+                events = dict(pending)
+                pending.clear()
+
+            if any(events.values()):
+                file_changed(sorted(events))
+            else:
+                file_modified(sorted(events))
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+"""
+## Changes from git
+
+In CI the documentation of the last documented commit is usually at hand, and only the files \
+changed since then need new pages:
+
+    pyccoon -s src -d docs --since v1.2
+
+asks the local git repository which files of the source folder were added, modified, deleted \
+or renamed between the revision and the working tree, including the new files git does not \
+track yet. Nothing is fetched, the revision has to be known to the local repository.
+"""
+
+import subprocess
+
+
+def git(folder, *args):
+    """ Run a git command in the `folder` and return its output as text """
+    try:
+        process = subprocess.Popen(('git',) + args, cwd=folder,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise IOError("Cannot run git: {0}".format(e))
+    out, err = process.communicate()
+    if process.returncode:
+        raise IOError("git {0} failed: {1}".format(args[0], err.decode('utf8', 'replace').strip()))
+    return out.decode('utf8')
+
+
+def changes(folder, rev):
+    """
+    Return the `(changed, deleted, moved)` paths relative to the `folder` since the commit \
+    `rev`: the added and modified files, the deleted ones, and whether any file was added, \
+    deleted or renamed at all, which changes the folder contents.
+    """
+    changed, deleted, moved = set(), set(), False
+
+    # `-z` output is `status NUL path NUL`, with two paths for the renames and copies.
+    fields = git(folder, 'diff', '--name-status', '-z', '-M', '--relative', rev, '--') \
+        .split('\0')
+    i = 0
+    while i < len(fields) - 1:
+        status, path = fields[i], fields[i + 1]
+        i += 2
+        if status[0] in 'RC':
+            if status[0] == 'R':
+                deleted.add(path)
+            path = fields[i]
+            i += 1
+        if status[0] == 'D':
+            deleted.add(path)
+        else:
+            changed.add(path)
+        moved = moved or status[0] in 'ADRC'
+
+    untracked = [path for path in
+                 git(folder, 'ls-files', '--others', '--exclude-standard', '-z').split('\0')
+                 if path]
+    changed.update(untracked)
+    return changed, deleted, moved or bool(untracked)
@@ -1,8 +1,37 @@
 
 import os
+import gzip
+import json
+import markdown
+import re
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
 import unittest
-from pyccoon import Pyccoon
+import zipfile
+from datetime import datetime
+from pyccoon import Pyccoon, Renderer, render
+from pyccoon import sources, daemon, utils, vcs
+from pyccoon.daemon import Daemon
+from pyccoon.languages import sniff_language
+from pyccoon.server import DevServer, PageCache
+from pyccoon.output import BackgroundWriter, ArchiveWriter, archive_available
 from pyccoon.utils import SourceFile
+from benchmarks import corpus, run
+
+try:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import urlopen, HTTPError
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
 
 
 class FileTest(unittest.TestCase):
@@ -86,6 +115,76 @@ class DummyFileTest(FileTest):
         assert os.path.exists(self.output_name), "Dummy output file does not exist before test"
 
 
+class ProjectTest(unittest.TestCase):
+
+    """
+    Test case with a temporary project: the `files` are written to a temporary source folder, \
+    the pages are built into `output_folders` temporary output folders and everything is removed \
+    after the test. Subclasses add the files and the `options` they need, and the checks.
+    """
+
+    files = {}
+    options = {}
+    # Existing folder to build instead of a temporary one
+    sourcedir = None
+    output_folders = 1
+
+    def setUp(self):
+        self.outdirs = [tempfile.mkdtemp() for _ in range(self.output_folders)]
+        self.outdir = self.outdirs[0]
+        self.temporary = list(self.outdirs)
+        if self.sourcedir is None:
+            self.sourcedir = tempfile.mkdtemp()
+            self.temporary.append(self.sourcedir)
+        for name, contents in self.files.items():
+            self.write(name, contents)
+
+    def tearDown(self):
+        for folder in self.temporary:
+            shutil.rmtree(folder)
+
+    def write(self, name, contents):
+        """ Write a source file, creating its folders """
+        path = os.path.join(self.sourcedir, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(contents)
+
+    def build(self, outdir=None, process=True, **options):
+        """ Pyccoon instance for the project with the class `options` and the given ones """
+        config = {
+            'sourcedir':    self.sourcedir,
+            'outdir':       outdir or self.outdir,
+            'verbosity':    0,
+        }
+        config.update(self.options)
+        config.update(options)
+        return Pyccoon(config, process=process)
+
+    def output(self, name, outdir=None):
+        return os.path.join(outdir or self.outdir, name)
+
+    def read(self, name, outdir=None):
+        with open(self.output(name, outdir)) as f:
+            return f.read()
+
+    def read_tree(self, outdir=None):
+        """ Contents of every file of the `outdir` by its relative path """
+        outdir = outdir or self.outdir
+        tree = {}
+        for dirpath, _, files in os.walk(outdir):
+            for name in files:
+                with open(os.path.join(dirpath, name), "rb") as f:
+                    tree[os.path.relpath(os.path.join(dirpath, name), outdir)] = f.read()
+        return tree
+
+    def read_pages(self, names, outdir=None):
+        """ The pages with the `names`, without the generation time """
+        return dict((name, re.sub(r"<code>[\d\- :]+</code>", "", self.read(name, outdir)))
+                    for name in names)
+
+
 class PyDocSubstitutions(DummyFileTest):
     input = """# :return:
                # :param something:
@@ -216,3 +315,927 @@ class RubyLanguage(FileTest):
 
         self.assertTrue(sections[11]['code_text'].count('end') == 1,
                         "Indentation splitting does not work")
+
+
+class IncrementalBuild(ProjectTest):
+
+    """ Incremental builds: unchanged files are skipped, changed ones are regenerated """
+
+    files = dict((name, "# Docs of {0}\nx = 1\n".format(name))
+                 for name in ["first.py", "second.py"])
+    options = {'incremental': True}
+
+    def test(self):
+        self.assertEqual(self.build().stats, {'rebuilt': 2, 'skipped': 0})
+        self.assertEqual(self.build().stats, {'rebuilt': 0, 'skipped': 2})
+
+        with open(os.path.join(self.sourcedir, "second.py"), "a") as f:
+            f.write("y = 2\n")
+        self.assertEqual(self.build().stats, {'rebuilt': 1, 'skipped': 1})
+
+        os.unlink(self.output("first.py.html"))
+        self.assertEqual(self.build().stats, {'rebuilt': 1, 'skipped': 1})
+
+
+class ParallelBuild(ProjectTest):
+
+    """ Pages generated by a pool of worker processes are identical to the serial ones """
+
+    sourcedir = os.path.split(os.path.abspath(__file__))[0]
+    output_folders = 2
+    pages = ["python_test_sample.py.html", "ruby_test_sample.rb.html", "tests.py.html"]
+
+    def test(self):
+        for outdir, jobs in zip(self.outdirs, [1, 3]):
+            self.build(outdir, jobs=jobs)
+        self.assertEqual(self.read_pages(self.pages, self.outdirs[0]),
+                         self.read_pages(self.pages, self.outdirs[1]))
+
+
+class ResolutionCache(ProjectTest):
+
+    """ Languages are guessed once per file, even when nothing can be guessed """
+
+    files = {"README": "Nothing to guess here\n"}
+
+    def setUp(self):
+        super(ResolutionCache, self).setUp()
+        self.guesses = []
+        self.guess_language = sources.guess_language
+        sources.guess_language = lambda code: self.guesses.append(code)
+
+    def tearDown(self):
+        sources.guess_language = self.guess_language
+        super(ResolutionCache, self).tearDown()
+
+    def test(self):
+        pyccoon = self.build(process=False)
+        self.assertEqual(len(self.guesses), 1)
+
+        for _ in range(3):
+            pyccoon.loader.clear()
+            self.assertEqual(pyccoon.destination("README"), self.output("README"))
+            self.assertEqual(pyccoon.get_language("README"), None)
+        self.assertEqual(len(self.guesses), 1)
+
+        with open(os.path.join(self.sourcedir, "README"), "a") as f:
+            f.write("Still nothing\n")
+        pyccoon.loader.clear()
+        pyccoon.destination("README")
+        self.assertEqual(len(self.guesses), 2)
+
+
+class LanguageSniffing(ResolutionCache):
+
+    """ Files without a known extension are recognized before Pygments is asked """
+
+    files = {
+        "bin/deploy":       "#!/usr/bin/env -S PYTHONPATH=. python3 -u\nprint(1)\n",
+        "Rakefile":         "task :default\n",
+        "scripts/build":    "echo 1\n",
+        "notes":            "Nothing to guess here\n",
+    }
+
+    def setUp(self):
+        super(LanguageSniffing, self).setUp()
+        self.config_file = self.output(".pyccoon.yaml")
+        with open(self.config_file, "w") as f:
+            f.write("files:\n  languages:\n    'scripts/*': Ruby\n    '*.inc': Klingon\n")
+
+    def name(self, code):
+        language = sniff_language(code)
+        return language.name if language else None
+
+    def test(self):
+        self.assertEqual(self.name("#!/usr/bin/python2.7\n"), "Python")
+        self.assertEqual(self.name("#!/usr/bin/env node\n"), "JavaScript")
+        self.assertEqual(self.name("#!/bin/sh\n# -*- mode: ruby; coding: utf-8 -*-\n"), "Ruby")
+        self.assertEqual(self.name("-- -*- lua -*-\n"), "Lua")
+        self.assertEqual(self.name("x\n" * 1000 + "# vim: set ft=perl:\n"), "Perl")
+        self.assertEqual(self.name("#!/bin/sh\necho 1\n"), None)
+
+    def test_build(self):
+        pyccoon = self.build(process=False, config_file=self.config_file)
+        self.assertEqual(pyccoon.language_patterns, [("scripts/*", "Ruby")])
+        self.assertEqual(pyccoon.get_language("bin/deploy").name, "Python")
+        self.assertEqual(pyccoon.get_language("Rakefile").name, "Ruby")
+        self.assertEqual(pyccoon.get_language("scripts/build").name, "Ruby")
+        self.assertEqual(pyccoon.get_language("notes"), None)
+        # Only the file nothing else could recognize is guessed, from a bounded prefix.
+        self.assertEqual(self.guesses, ["Nothing to guess here\n"])
+
+
+class LanguageGuessing(ProjectTest):
+
+    """ Files nothing else recognizes are guessed by Pygments """
+
+    files = {
+        "helpers":  "import os\n\n\ndef path(self):\n    return os.getcwd()\n",
+        "main":     "#include <stdio.h>\nint main() { return 0; }\n",
+        "notes":    "Nothing to guess here\n",
+    }
+
+    def test(self):
+        pyccoon = self.build(process=False)
+        self.assertEqual(pyccoon.get_language("helpers").name, "Python")
+        self.assertEqual(pyccoon.get_language("main").name, "C")
+        self.assertEqual(pyccoon.get_language("notes"), None)
+
+
+class SingleRead(ProjectTest):
+
+    """ Every source file is read once per build, whichever steps need its contents """
+
+    files = {
+        "a.py":             "# Uses [[b.py]] and [[tool]]\nx = 1\n",
+        "b.py":             "# See [[a.py]]\ny = 2\n",
+        "tool":             "#!/usr/bin/env python\n# A script\nz = 3\n",
+        "notes.txt":        "Plain text\n",
+        "pkg/__init__.py":  "# Package\n",
+        "logo.png":         "\x89PNG\x00\x00\x01",
+    }
+
+    def test(self):
+        reads = {}
+
+        def counting(open):
+            def wrapper(path, mode='r', *args, **kwargs):
+                if isinstance(path, str) and path.startswith(self.sourcedir) and 'w' not in mode:
+                    name = os.path.relpath(path, self.sourcedir)
+                    reads[name] = reads.get(name, 0) + 1
+                return open(path, mode, *args, **kwargs)
+            return wrapper
+
+        builtins = sys.modules['builtins' if sys.version_info[0] > 2 else '__builtin__']
+        modules = [module for name, module in list(sys.modules.items())
+                   if module is not None and name.startswith("pyccoon") and 'open' in vars(module)]
+        originals = [(module, module.open) for module in modules + [builtins]]
+        for module, open in originals:
+            module.open = counting(open)
+        try:
+            for options in [{}, {'incremental': True}, {'incremental': True}]:
+                reads.clear()
+                self.build(**options)
+                # Only the first bytes of binary files are read before they are copied.
+                self.assertEqual(reads, dict((name, 2 if name == "logo.png" else 1)
+                                             for name in self.files))
+        finally:
+            for module, open in originals:
+                module.open = open
+        self.assertTrue('href="b.py.html"' in self.read("a.py.html"))
+
+
+class FolderIndexes(ProjectTest):
+
+    """ Every output folder gets an index page, but existing index pages are not overwritten """
+
+    files = {
+        "pkg/__init__.py":      "# Package docs\n",
+        "pkg/sub/module.py":    "x = 1\n",
+        "other/deep/script.py": "y = 2\n",
+    }
+
+    def test(self):
+        pyccoon = self.build()
+
+        for folder in ["", "pkg", "pkg/sub", "other", "other/deep"]:
+            self.assertTrue(os.path.exists(self.output(os.path.join(folder, "index.html"))),
+                            "Missing index of '{0}'".format(folder))
+
+        self.assertTrue("Package docs" in self.read("pkg/index.html"),
+                        "Package index page was overwritten")
+
+        self.assertEqual(pyccoon.tree.missing_indexes(), [])
+        self.assertEqual(pyccoon.tree.children("other"), (["deep"], ["index.html"]))
+
+
+class SkippedFolders(ProjectTest):
+
+    """ Skipped folders are never listed, and the combined skip patterns match like each one """
+
+    files = {
+        "a.py":                 "x = 1\n",
+        "keep/b.py":            "y = 2\n",
+        "build/c.py":           "z = 3\n",
+        "build/deep/d.py":      "w = 4\n",
+        "keep/.git/config":     "",
+    }
+
+    def walk(self, skip):
+        """ `(dirpath, files)` of the `walk`, and the folders listed by it """
+        listed = []
+        scandir, listdir = utils.scandir, os.listdir
+        if scandir:
+            utils.scandir = lambda path: listed.append(path) or scandir(path)
+        else:
+            os.listdir = lambda path: listed.append(path) or listdir(path)
+        try:
+            folders = [(os.path.relpath(dirpath, self.sourcedir), sorted(files))
+                       for dirpath, files in utils.walk(self.sourcedir, skip)]
+        finally:
+            utils.scandir, os.listdir = scandir, listdir
+        return folders, [os.path.relpath(path, self.sourcedir) for path in listed]
+
+    def test(self):
+        skip = utils.combine_patterns([r"^build$", re.compile(r"\.git")])
+        folders, listed = self.walk(lambda path: skip.search(os.path.basename(path)))
+        self.assertEqual(folders, [(".", ["a.py"]), ("keep", ["b.py"])])
+        self.assertEqual(listed, [".", "keep"])
+
+    def test_fallback(self):
+        """ Without `scandir`, the folders are listed by `os.listdir` """
+        scandir, utils.scandir = utils.scandir, None
+        try:
+            folders, listed = self.walk(lambda path: os.path.basename(path) == "build")
+        finally:
+            utils.scandir = scandir
+        self.assertEqual(folders, [(".", ["a.py"]), ("keep", ["b.py"]), ("keep/.git", ["config"])])
+        self.assertEqual(listed, [".", "keep", "keep/.git"])
+
+    def test_patterns(self):
+        patterns = [r"^build$", r"\.git", r".+\.pyc$", re.compile(r"^_"), r"a|b"]
+        combined = utils.combine_patterns(patterns)
+        for name in ["build", "builds", ".git", ".gitignore", "x.pyc", "x.py", "_private", "a",
+                     "cd", "", "b.py"]:
+            self.assertEqual(bool(combined.search(name)),
+                             any(re.search(pattern, name) for pattern in patterns), name)
+        self.assertEqual(utils.combine_patterns([]).search(""), None)
+
+
+class Regenerate(ProjectTest):
+
+    """ The `watch` mode regenerates only the changed pages and the indexes of their folders """
+
+    files = {"first.py": "x = 1\n", "second.py": "x = 1\n"}
+
+    def test(self):
+        pyccoon = self.build()
+        pyccoon.regenerate(["first.py"])
+        self.assertEqual(pyccoon.stats['rebuilt'], 1)
+
+        # Unknown files and outputs are ignored
+        pyccoon.stats = None
+        pyccoon.regenerate(["first.py.html"])
+        self.assertEqual(pyccoon.stats, None)
+
+        self.assertFalse("third.py" in self.read("index.html"))
+        self.write("third.py", "z = 3\n")
+        pyccoon.regenerate(["third.py"], collect=True)
+        self.assertEqual(pyccoon.stats['rebuilt'], 1)
+        self.assertTrue(os.path.exists(self.output("third.py.html")))
+        self.assertTrue("third.py" in self.read("index.html"))
+
+
+class CrossrefDependencies(ProjectTest):
+
+    """ Pages are rebuilt when the sources they link to are moved or deleted """
+
+    files = {
+        "page.py":      "# See [[target.py#section]]\nx = 1\n",
+        "target.py":    "# ## Section\ny = 2\n",
+        "other.py":     "w = 0\n",
+    }
+    options = {'incremental': True}
+
+    def test(self):
+        pyccoon = self.build()
+        self.assertEqual(pyccoon.dependencies.referrers(["target.py"]), set(["page.py"]))
+        self.assertEqual(list(pyccoon.dependencies.broken_links()), [])
+
+        os.rename(os.path.join(self.sourcedir, "target.py"),
+                  os.path.join(self.sourcedir, "target.txt"))
+        self.assertEqual(self.build().stats, {'rebuilt': 1, 'skipped': 1})
+
+        self.write("target.py", "z = 3\n")
+        pyccoon = self.build()
+        self.assertEqual(pyccoon.stats, {'rebuilt': 2, 'skipped': 1})
+        self.assertEqual(list(pyccoon.dependencies.broken_links()),
+                         [("page.py", "target.py", "section")])
+
+
+class BackgroundWriting(ProjectTest):
+
+    """ Files are written by the background threads and the failures are reported on flush """
+
+    def test(self):
+        writer = BackgroundWriter(threads=2, maxsize=2)
+        for i in range(10):
+            writer.write(self.output("{0}.html".format(i)), u"page {0}".format(i))
+        missing = self.output(os.path.join("missing", "page.html"))
+        writer.write(missing, u"nowhere")
+
+        failures = writer.flush()
+        writer.close()
+        self.assertEqual([path for path, _ in failures], [missing])
+        self.assertEqual(len(os.listdir(self.outdir)), 10)
+        self.assertEqual(self.read("7.html"), "page 7")
+
+
+class CompareOutput(ProjectTest):
+
+    """ With `compare`, files with the same contents are not written again """
+
+    files = {"code.py": "# Docs\nx = 1\n"}
+    options = {'compare': True}
+
+    def setUp(self):
+        super(CompareOutput, self).setUp()
+        with open(os.path.join(self.sourcedir, "image.png"), "wb") as f:
+            f.write(b"\x89PNG\r\n\x1a\n\x00\x00")
+
+    def test(self):
+        # The CSS, two static images, the copied PNG, the page and the index
+        self.assertEqual(self.build().output.changed, 6)
+
+        outputs = [self.output(name) for name in ["pyccoon.css", "image.png"]]
+        for path in outputs:
+            os.utime(path, (0, 0))
+
+        pyccoon = self.build()
+        self.assertEqual(pyccoon.output.files, 6)
+        self.assertTrue(pyccoon.output.changed <= 2)
+        for path in outputs:
+            self.assertEqual(os.path.getmtime(path), 0)
+
+
+class PrecompressedOutput(CompareOutput):
+
+    """ Compressed variants are written for the text files, again only when they change """
+
+    options = {'precompress': "gz"}
+
+    def test(self):
+        self.build()
+        css, page = [self.output(name) for name in ["pyccoon.css", "code.py.html"]]
+        for path in [css, page]:
+            with gzip.open(path + ".gz", "rb") as f, open(path, "rb") as original:
+                self.assertEqual(f.read(), original.read())
+            os.utime(path + ".gz", (0, 0))
+        self.assertFalse(os.path.exists(self.output("image.png.gz")))
+
+        self.write("code.py", "# Changed docs\nx = 1\n")
+        self.build()
+        self.assertEqual(os.path.getmtime(css + ".gz"), 0)
+        self.assertNotEqual(os.path.getmtime(page + ".gz"), 0)
+
+
+class ReproducibleBuild(ProjectTest):
+
+    """ Reproducible builds of the same sources are byte-identical """
+
+    files = dict((name, "# Docs of {0}\nx = 1\n".format(name))
+                 for name in ["package/__init__.py", "package/b.py", "package/a.py", "main.py"])
+    options = {'reproducible': True}
+    output_folders = 2
+
+    def setUp(self):
+        super(ReproducibleBuild, self).setUp()
+        for name in self.files:
+            os.utime(os.path.join(self.sourcedir, name), (0, 86400))
+        self.epoch = os.environ.pop('SOURCE_DATE_EPOCH', None)
+
+    def tearDown(self):
+        if self.epoch is not None:
+            os.environ['SOURCE_DATE_EPOCH'] = self.epoch
+        super(ReproducibleBuild, self).tearDown()
+
+    def test(self):
+        for outdir in self.outdirs:
+            self.build(outdir)
+        trees = [self.read_tree(outdir) for outdir in self.outdirs]
+        self.assertEqual(trees[0], trees[1])
+        self.assertTrue(b"<code>1970-01-02 00:00</code>" in trees[0]["main.py.html"])
+
+        os.environ['SOURCE_DATE_EPOCH'] = "1000000000"
+        self.build()
+        page = self.read_tree()["main.py.html"]
+        self.assertTrue(b"<code>2001-09-09 01:46</code>" in page)
+        del os.environ['SOURCE_DATE_EPOCH']
+
+
+class ArchiveOutput(ReproducibleBuild):
+
+    """ An archive destination holds the same files as the output folder """
+
+    def read_archive(self, path):
+        if path.endswith(".zip"):
+            with zipfile.ZipFile(path) as archive:
+                return dict((name, archive.read(name)) for name in archive.namelist())
+        with tarfile.open(path) as archive:
+            return dict((member.name, archive.extractfile(member).read())
+                        for member in archive.getmembers())
+
+    def test(self):
+        self.build()
+        tree = self.read_tree()
+        folder = self.outdirs[1]
+        for name, jobs in [("docs.zip", 2), ("docs.tar.gz", 1), ("again.tar.gz", 1)]:
+            self.build(os.path.join(folder, name), jobs=jobs)
+            self.assertEqual(self.read_archive(os.path.join(folder, name)), tree)
+
+        self.assertEqual(sorted(os.listdir(folder)), ["again.tar.gz", "docs.tar.gz", "docs.zip"])
+        with open(os.path.join(folder, "docs.tar.gz"), "rb") as a, \
+                open(os.path.join(folder, "again.tar.gz"), "rb") as b:
+            self.assertEqual(a.read(), b.read())
+
+    def test_regenerate(self):
+        """ The archive written anew by the watch mode still has the generated index pages """
+        self.build()
+        path = os.path.join(self.outdirs[1], "docs.zip")
+        pyccoon = self.build(path)
+        pyccoon.regenerate(["main.py"])
+        pyccoon.regenerate(["package/a.py"])
+        self.assertEqual(self.read_archive(path), self.read_tree())
+
+    def test_failure(self):
+        """ A failed build leaves neither the unfinished archive nor its temporary file """
+        folder = self.outdirs[1]
+        self.build()
+        self.build(os.path.join(folder, "docs.zip"))
+        for name in ["docs.zip", "new.tar.gz"]:
+            pyccoon = self.build(os.path.join(folder, name), process=False)
+            pyccoon.custom_css_path = os.path.join(self.outdir, "missing.css")
+            self.assertRaises(IOError, pyccoon.process)
+        self.assertEqual(os.listdir(folder), ["docs.zip"])
+        self.assertEqual(self.read_archive(os.path.join(folder, "docs.zip")), self.read_tree())
+
+    def test_unsupported(self):
+        """ Archives this Python cannot write are refused before their temporary file is created """
+        folder = self.outdirs[1]
+        path = os.path.join(folder, "docs.tar.xz")
+        if archive_available('xz'):
+            self.build()
+            self.build(path)
+            self.assertEqual(self.read_archive(path), self.read_tree())
+        else:
+            self.assertRaises(ValueError, self.build, path)
+            self.assertRaises(tarfile.CompressionError, ArchiveWriter, path, self.outdir)
+            self.assertEqual(os.listdir(folder), [])
+
+        # A failure while starting the archive removes the temporary file as well.
+        def fail(writer, compression):
+            raise IOError("No space left on device")
+        original, ArchiveWriter.open = ArchiveWriter.open, fail
+        try:
+            self.assertRaises(IOError, ArchiveWriter, os.path.join(folder, "docs.zip"), self.outdir)
+        finally:
+            ArchiveWriter.open = original
+        self.assertFalse(os.path.exists(os.path.join(folder, "docs.zip.tmp")))
+
+
+class Profile(ProjectTest):
+
+    """ The profile report lists the stages and the slowest files, also from worker processes """
+
+    sourcedir = os.path.split(os.path.abspath(__file__))[0]
+
+    def test(self):
+        report_file = self.output("profile.json")
+        for jobs in [1, 2]:
+            self.build(jobs=jobs, profile=report_file, profile_top=2)
+            report = json.loads(self.read("profile.json"))
+            trace = json.loads(self.read("profile.trace.json"))
+
+            for stage in ["read", "parse", "highlight", "markdown", "render", "write"]:
+                self.assertTrue(report['stages'][stage]['calls'] > 0)
+            # The background writers time the writing in their own threads.
+            threads = dict((event['name'], event['tid']) for event in trace['traceEvents'])
+            if jobs == 1:
+                self.assertTrue(report['stages']['queue']['calls'] > 0)
+                self.assertNotEqual(threads['write'], threads['page'])
+            self.assertEqual(len(report['slowest']), 2)
+            self.assertTrue(report['slowest'][0]['wall'] >= report['slowest'][1]['wall'])
+            self.assertTrue(report['slowest'][0]['sections'] > 0)
+            self.assertTrue(report['total']['bytes'] > 0)
+            self.assertTrue(any(event['name'] == "page" for event in trace['traceEvents']))
+
+
+class BenchmarkCorpus(ProjectTest):
+
+    """ The benchmark corpus is reproducible and regressions are detected """
+
+    output_folders = 2
+
+    def test(self):
+        sizes = [corpus.generate(folder, "many", scale=0.1) for folder in self.outdirs]
+        self.assertEqual(sizes[0], sizes[1])
+        self.assertEqual(sorted(os.listdir(self.outdirs[0])), sorted(corpus.LANGUAGES))
+        name = os.path.join("python", "file2.py")
+        self.assertEqual(self.read(name, self.outdirs[0]), self.read(name, self.outdirs[1]))
+
+        changes = run.compare({'fast': 100.0, 'slow': 75.0, 'new': 1.0},
+                              {'fast': 80.0, 'slow': 100.0})
+        self.assertEqual(changes, [('fast', 0.25), ('slow', -0.25)])
+
+    def test_writers(self):
+        write = run.OutputWriter.write
+        results = run.run(repeat=1, scale=0.1, only="^writers/")
+        self.assertEqual(sorted(results), ["writers/0/many", "writers/2/many"])
+        self.assertEqual(run.OutputWriter.write, write)
+
+    def test_rss(self):
+        corpus.generate(self.outdirs[0], "many", scale=0.1)
+        # The build runs in a fresh interpreter, which does not start as big as this process.
+        ballast = b"x" * (128 * 1024 * 1024)
+        rss = run.peak_rss(run.build, self.outdirs[0], self.outdirs[1], True)
+        self.assertTrue(0 < rss < len(ballast) // 1024, rss)
+
+
+class LazyImports(unittest.TestCase):
+
+    """ Pygments, Markdown, YAML and pystache are only imported when a page is rendered """
+
+    heavy = ["pygments", "markdown", "yaml", "pystache", "pypandoc"]
+
+    def output(self, script):
+        """ What the `script` prints in a fresh interpreter """
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            [root] + [path for path in [os.environ.get('PYTHONPATH')] if path]))
+        return subprocess.check_output([sys.executable, "-c", script], env=env).decode('utf8')
+
+    def loaded(self, script):
+        modules = self.output(script + "; import sys; print(' '.join(sorted(sys.modules)))")
+        return [name for name in self.heavy if name in modules.split()]
+
+    def test(self):
+        self.assertEqual(self.loaded("import pyccoon.pyccoon"), [])
+        self.assertEqual(self.loaded("import pyccoon; pyccoon.render('a.py', '# Docs')"),
+                         ["pygments", "markdown", "pystache"])
+
+        names = [name for name, _, _ in run.import_benchmarks(1)]
+        self.assertEqual(names, ["import/pyccoon", "import/version"])
+        self.assertEqual(run.compare({'import/pyccoon': 50.0}, {'import/pyccoon': 100.0}),
+                         [('import/pyccoon', 1.0)])
+
+    def test_languages(self):
+        # Looking a language up by its name creates no other language
+        script = ("from pyccoon import languages; languages.find_language('Coffee-Script'); "
+                  "print(' '.join(type(instance).__name__ "
+                  "for instance in languages._instances.values()))")
+        self.assertEqual(self.output(script).split(), ["CoffeeScript"])
+
+
+class StreamingBuild(ParallelBuild):
+
+    """ Streaming builds give the same pages and keep no file contents after the build """
+
+    output_folders = 3
+
+    def test(self):
+        for outdir, streaming, jobs in zip(self.outdirs, [False, True, True], [1, 1, 2]):
+            pyccoon = self.build(outdir, streaming=streaming, jobs=jobs)
+            if streaming:
+                self.assertEqual(pyccoon.loader.records, {})
+                self.assertEqual(getattr(pyccoon, 'sections', None), None)
+        pages = [self.read_pages(self.pages, outdir) for outdir in self.outdirs]
+        self.assertEqual(pages[0], pages[1])
+        self.assertEqual(pages[0], pages[2])
+
+
+class LargeFiles(ProjectTest):
+
+    """ Files above the `files: large:` thresholds are chunked, shown as plain text or copied """
+
+    files = {
+        "big.py":   "\n".join("# Function number {0}\ndef f{0}():\n    return {0}\n".format(i)
+                              for i in range(30)),
+        "small.py": "# Small\nx = 1\n",
+    }
+
+    def build_large(self, **large):
+        pyccoon = self.build(process=False)
+        pyccoon.large_files.update(large)
+        pyccoon.collect_sources()
+        pyccoon.process()
+        return sorted(os.listdir(self.outdir))
+
+    def test_chunk(self):
+        outputs = self.build_large(lines=100, **{'chunk-lines': 50})
+        self.assertTrue("big.py.2.html" in outputs and "big.py.3.html" in outputs)
+        self.assertFalse("big.py.4.html" in outputs)
+        self.assertTrue("Large file." in self.read("big.py.html"))
+        self.assertTrue('href="big.py.3.html"' in self.read("big.py.2.html"))
+        self.assertTrue("Function number 29" in self.read("big.py.3.html"))
+        self.assertFalse("Large file." in self.read("small.py.html"))
+
+    def test_plain(self):
+        outputs = self.build_large(size=500, mode='plain')
+        self.assertFalse("big.py.2.html" in outputs)
+        page = self.read("big.py.html")
+        self.assertTrue("shown as plain text" in page)
+        self.assertTrue("# Function number 29" in page)
+
+    def test_copy(self):
+        outputs = self.build_large(size=500, mode='copy')
+        self.assertTrue("big.py" in outputs)
+        self.assertFalse("big.py.html" in outputs)
+        self.assertTrue("small.py.html" in outputs)
+
+
+class ShardedBuild(ProjectTest):
+
+    """ Shards merged together give the same tree as a single build """
+
+    files = dict((os.path.join(folder, name),
+                  "# [[a.py]] in {0}\nx = 1\n".format(folder or "root")
+                  if name != "data.bin" else "\0\1\2")
+                 for folder in ["", "package", "package/sub"]
+                 for name in ["a.py", "b.rb", "c.js", "notes.txt", "data.bin"])
+    files["package/__init__.py"] = "# The package\n"
+    options = {'reproducible': True}
+    output_folders = 5
+
+    def setUp(self):
+        super(ShardedBuild, self).setUp()
+        self.epoch = os.environ.get('SOURCE_DATE_EPOCH')
+        os.environ['SOURCE_DATE_EPOCH'] = "0"
+
+    def tearDown(self):
+        if self.epoch is None:
+            del os.environ['SOURCE_DATE_EPOCH']
+        else:
+            os.environ['SOURCE_DATE_EPOCH'] = self.epoch
+        super(ShardedBuild, self).tearDown()
+
+    def test(self):
+        single, merged, shards = self.outdirs[0], self.outdirs[1], self.outdirs[2:]
+        self.build(single)
+
+        for i, shard in enumerate(shards):
+            self.build(shard, shard="{0}/{1}".format(i + 1, len(shards)))
+        self.assertFalse(any(os.path.exists(os.path.join(shard, "pyccoon.css"))
+                             for shard in shards))
+        pages = [set(self.read_tree(shard)) for shard in shards]
+        self.assertEqual(sum(len(part) for part in pages), len(set.union(*pages)))
+
+        self.build(merged, process=False).merge(shards)
+        self.assertEqual(self.read_tree(merged), self.read_tree(single))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.build, shard="3/2")
+
+
+class BuildDaemon(ProjectTest):
+
+    """ The daemon builds and renders pages on request """
+
+    files = dict((name, "# Docs of {0}\nx = 1\n".format(name)) for name in ["a.py", "b.py"])
+
+    def setUp(self):
+        super(BuildDaemon, self).setUp()
+        self.socket = os.path.join(tempfile.mkdtemp(), "pyccoon.sock")
+        self.temporary.append(os.path.dirname(self.socket))
+        self.daemon = Daemon(self.build(), self.socket)
+        self.thread = threading.Thread(target=self.daemon.serve)
+        self.thread.start()
+
+    def tearDown(self):
+        if self.thread.is_alive():
+            daemon.request(self.socket, {'command': 'stop'})
+        self.thread.join()
+        super(BuildDaemon, self).tearDown()
+
+    def send(self, **message):
+        return daemon.request(self.socket, message)
+
+    def test(self):
+        self.assertTrue(self.send(command='ping')['ok'])
+
+        self.write("a.py", "# Changed docs\nx = 2\n")
+        response = self.send(command='build', paths=[os.path.join(self.sourcedir, "a.py")])
+        self.assertEqual(response['stats']['rebuilt'], 1)
+        self.assertTrue("Changed docs" in self.read("a.py.html"))
+
+        self.write("c.py", "# New file\n")
+        self.assertEqual(self.send(command='build', paths=["c.py"])['stats']['rebuilt'], 1)
+        self.assertTrue(os.path.exists(self.output("c.py.html")))
+
+        response = self.send(command='render', path="b.py", code="# Not saved yet\ny = 3\n")
+        self.assertTrue("Not saved yet" in response['html'])
+
+        response = self.send(command='unknown')
+        self.assertFalse(response['ok'])
+
+        self.send(command='stop')
+        self.thread.join()
+        self.assertFalse(os.path.exists(self.socket))
+
+    def test_warm(self):
+        created = []
+        original = markdown.Markdown
+
+        class Converter(original):
+            def __init__(self, *args, **kwargs):
+                created.append(self)
+                original.__init__(self, *args, **kwargs)
+
+        markdown.Markdown = Converter
+        try:
+            # Each request comes on a new connection
+            for i in range(2):
+                response = self.send(command='render', path="a.py", code="# Docs {0}\n".format(i))
+                self.assertTrue("Docs {0}".format(i) in response['html'])
+        finally:
+            markdown.Markdown = original
+        self.assertEqual(len(created), 1)
+
+
+class DevServerPages(ProjectTest):
+
+    """ The development server renders the pages on request and caches them """
+
+    files = {"a.py": "# Docs of a\nx = 1\n", "pkg/b.py": "# Docs of b\ny = 2\n"}
+
+    def setUp(self):
+        super(DevServerPages, self).setUp()
+        self.server = DevServer(self.build(process=False), ('127.0.0.1', 0))
+        self.collects = []
+        collect = self.server.collect
+        self.server.collect = lambda: self.collects.append(collect())
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        super(DevServerPages, self).tearDown()
+
+    def get(self, path):
+        url = "http://127.0.0.1:{0}{1}".format(self.server.server_address[1], path)
+        try:
+            return urlopen(url).read().decode('utf8')
+        except HTTPError as e:
+            return e.code
+
+    def test(self):
+        # The sources are mapped without reading them
+        self.assertTrue(self.server.pyccoon.loader.records["a.py"].peeked)
+
+        self.assertTrue("Docs of a" in self.get("/a.py.html"))
+        self.assertTrue("Docs of a" in self.get("/a.py.html"))
+        self.assertEqual((self.server.cache.hits, self.server.cache.misses), (1, 1))
+
+        self.write("a.py", "# Changed docs of a\nx = 1\n")
+        self.assertTrue("Changed docs" in self.get("/a.py.html"))
+
+        self.assertTrue("b.py" in self.get("/pkg/"))
+        self.assertTrue("Docs of b" in self.get("/pkg/b.py.html"))
+        self.assertTrue(self.get("/pyccoon.css").strip())
+
+        self.write("c.py", "# New file\n")
+        self.assertTrue("New file" in self.get("/c.py.html"))
+        self.assertEqual(len(self.collects), 1)
+
+        # The cached index page lists the new file, whichever page is requested first
+        self.write("pkg/d.py", "# New file in pkg\n")
+        self.assertTrue("d.py" in self.get("/pkg/"))
+        self.write("pkg/e.py", "# Another one\n")
+        self.assertTrue("Another one" in self.get("/pkg/e.py.html"))
+        self.assertTrue("e.py" in self.get("/pkg/"))
+        self.assertEqual(len(self.collects), 3)
+
+        # Missing pages in unchanged folders do not collect the sources again
+        for path in ["/favicon.ico", "/missing.py.html", "/pkg/missing.py.html", "/no/such.html"]:
+            self.assertEqual(self.get(path), 404)
+        self.assertEqual(self.get("/../etc/passwd"), 404)
+        self.assertEqual(len(self.collects), 3)
+        self.assertEqual(os.listdir(self.outdir), [])
+
+
+class PageCacheSize(unittest.TestCase):
+
+    def test(self):
+        cache = PageCache(10)
+        cache.put('a', 1, b"12345")
+        cache.put('b', 1, b"12345")
+        self.assertEqual(cache.get('a', 1), b"12345")
+        cache.put('c', 1, b"123")
+        # `b` is the least recently used page.
+        self.assertEqual(cache.get('b', 1), None)
+        self.assertEqual(cache.get('a', 2), None)
+        self.assertEqual(cache.used, 3)
+
+
+class RenderInMemory(unittest.TestCase):
+
+    """ Pages are rendered from strings, without touching the file system """
+
+    code = "# Docs of {0}\n# See [[b.rb]]\nx = {0}\n"
+
+    def test(self):
+        html = render("lib/a.py", self.code.format(1))
+        self.assertTrue("Docs of 1" in html)
+        self.assertTrue('href="../b.rb.html"' in html)
+
+        sections = render("a.txt", self.code.format(2), language="Python", sections=True)
+        self.assertEqual(sections[0]['docs_text'].split("\n")[0], "Docs of 2")
+        self.assertTrue("highlight" in sections[0]['code_html'])
+
+        self.assertRaises(ValueError, render, "a.unknown", "", language="Cobol")
+
+    def test_batch(self):
+        files = [("f{0}.py".format(i), self.code.format(i)) for i in range(8)]
+        renderer = Renderer({'project': {'name': "Review"}}, generation_time=datetime(2020, 1, 1))
+        pages = renderer.render_many(files, threads=4)
+        self.assertEqual(pages, renderer.render_many(files))
+        for i, html in enumerate(pages):
+            self.assertTrue("Docs of {0}".format(i) in html)
+            self.assertTrue("Review" in html)
+
+
+class TokenParser(unittest.TestCase):
+
+    """ The token parser finds the docs and highlights the code in a single Pygments pass """
+
+    code = '''#!/usr/bin/env python
+# Module docs
+
+import os
+
+
+class A(object):
+    """ Class docs """
+
+    @property
+    def name(self):
+        # Returns the name
+        return "a"  # Not docs
+
+
+def b():
+    """ Function docs """
+    return 1
+'''
+
+    def sections(self, parser, path, code):
+        renderer = Renderer({'documentation': {'parsers': {'Python': parser, 'Lua': parser}}})
+        return [(section['docs_text'], section['code_text'].rstrip(),
+                 re.sub(r'\n+</pre>', '</pre>', section['code_html']))
+                for section in renderer.render(path, code, sections=True)]
+
+    def test_same_sections(self):
+        tokens = self.sections('tokens', "a.py", self.code)
+        self.assertEqual(tokens, self.sections('regex', "a.py", self.code))
+        self.assertEqual([docs.strip() for docs, _, _ in tokens],
+                         ["", "Module docs", "Class docs", "Returns the name", "Function docs"])
+        self.assertTrue("#!/usr/bin/env python" in tokens[0][2])
+
+    def test_strings(self):
+        code = 'x = """# Not docs"""\n# Docs\ny = 1\n'
+        self.assertEqual([docs for docs, _, _ in self.sections('tokens', "a.py", code)],
+                         ["", "Docs\n"])
+
+        code = "--[[ Block\ndocs --]]\n-- Line\nlocal x = 1\n"
+        self.assertEqual([docs for docs, _, _ in self.sections('tokens', "a.lua", code)],
+                         ["Block\ndocs ", "Line\n"])
+
+
+@unittest.skipIf(not which("git"), "git is not installed")
+class GitChanges(ProjectTest):
+
+    """ `--since` rebuilds the files changed in git and the pages linking to them, and removes \
+        the outputs of the deleted ones """
+
+    files = dict((name, "# Docs of {0}\nx = 1\n".format(name))
+                 for name in ["a.py", "b.py", "e.py", "g.py", "pkg/c.py"])
+    files["link.py"] = "# See [[g.py]]\nx = 1\n"
+    files["tool"] = "#!/usr/bin/env python\n# A script\n"
+    options = {'incremental': True}
+
+    def setUp(self):
+        super(GitChanges, self).setUp()
+        self.git("init", "-q")
+        self.git("add", ".")
+        self.git("-c", "user.name=Test", "-c", "user.email=test@example.com",
+                 "commit", "-q", "-m", "Initial")
+        self.build()
+
+    def git(self, *args):
+        vcs.git(self.sourcedir, *args)
+
+    def test(self):
+        os.utime(self.output("e.py.html"), (0, 0))
+        self.write("a.py", "# Changed docs\nx = 2\n")
+        self.git("rm", "-q", "b.py", "tool")
+        self.git("mv", "pkg/c.py", "pkg/d.py")
+        self.git("mv", "g.py", "h.py")
+        self.write("new.py", "# New file\n")
+
+        pyccoon = self.build(process=False)
+        pyccoon.process_since("HEAD")
+
+        self.assertTrue("Changed docs" in self.read("a.py.html"))
+        for name in ["b.py.html", "tool", "pkg/c.py.html", "g.py.html"]:
+            self.assertFalse(os.path.exists(self.output(name)), name)
+        for name in ["pkg/d.py.html", "h.py.html", "new.py.html"]:
+            self.assertTrue(os.path.exists(self.output(name)), name)
+        self.assertTrue("d.py" in self.read("pkg/index.html"))
+        # The page linking to the moved file is rebuilt, the others are left alone.
+        self.assertFalse('href="g.py.html"' in self.read("link.py.html"))
+        self.assertEqual(os.path.getmtime(self.output("e.py.html")), 0)
+        self.assertEqual(pyccoon.stats['rebuilt'], 5)
+
+        self.assertRaises(IOError, self.build(process=False).process_since, "no-such-revision")
+        self.assertRaises(ValueError, self.build(process=False, incremental=False).process_since,
+                          "HEAD")